@@ -0,0 +1,50 @@
+"""Internet checksum (RFC 1071), shared by ICMP, UDP and TCP style protocols."""
+
+import struct
+
+def checksum_py(data):
+    """Reference implementation, one byte at a time."""
+    s = 0
+    for i in range(len(data)):
+        s += data[i] << (0 if i & 1 else 8)
+        if s > 0xffff:
+            s -= 0xffff
+    return s ^ 0xffff
+
+def _sum16_struct(data, n):
+    # Sum big-endian 16-bit words, 64 words per struct call.
+    s = 0
+    i = 0
+    while n - i >= 128:
+        s += sum(struct.unpack_from("!64H", data, i))
+        i += 128
+    while n - i >= 2:
+        s += struct.unpack_from("!H", data, i)[0]
+        i += 2
+    if i < n:
+        s += data[i] << 8
+    return s
+
+try:
+    import micropython
+
+    @micropython.viper
+    def _sum16(data, n: int) -> int:
+        p = ptr8(data)
+        s = 0
+        i = 0
+        while i < n - 1:
+            s += (p[i] << 8) | p[i + 1]
+            i += 2
+        if i < n:
+            s += p[i] << 8
+        return s
+except:
+    _sum16 = _sum16_struct
+
+def checksum(data, initial = 0):
+    """Checksum of data; initial is a partial sum, e.g. of a UDP/TCP pseudo-header."""
+    s = initial + _sum16(data, len(data))
+    while s > 0xffff:
+        s = (s & 0xffff) + (s >> 16)
+    return s ^ 0xffff
@@ -2,14 +2,19 @@
 
  - Write module as a function or an object with __call__ method.
    It will be passed a WebRequest object when a request arrives.
-   It will be passed None periodically to allow background tasks.
+   It will be passed None periodically to allow background tasks;
+   set the period with add_module(..., interval = ms), or return
+   the number of ms until the next call from handler(None).
    See WebMain.__call__ and other __call__ methods for examples.
 
  - Write a main class similar to ExampleMain, derived from WebMain.
    All custom configuration should be done inside __init__.
    Remember to call super().__init__ with proper options.
    Add modules with add_module(handler, name_for_listing, uri).
-   Add static pages with add_static(path, uri).
+   Give the handler as "Module:Class" to import it only when needed.
+   With super().__init__(..., cache_size = bytes), add_module(...,
+   cache_ttl = ms) replays a module's GET responses until they expire.
+   Add static pages with add_static(path, uri, max_age_seconds).
    Start the server with MainClass.main().
 """
 
@@ -47,7 +52,6 @@ class ExampleMain(WebMain):
     def __init__(self):
         # Import modules.
         from SimpleWLAN import SimpleWLAN
-        from WebFileManager import WebFileManager
 
         # Start WLAN and initialize WebMain.
         # Needs wlan.conf: {"ssid": "MyNet", "key": "my-secrets", "ap": false}
@@ -57,7 +61,8 @@ class ExampleMain(WebMain):
         # Fail-safe: reboot if the network seems broken (ENOMEM in ping).
         def reboot_if_network_is_broken(request):
             if network.is_broken():
-                self._log("Network is broken.")
+                self._log("Network is broken.", self.logger.ERROR)
+                self.logger.flush()
                 import machine
                 machine.reset()
             else:
@@ -65,14 +70,17 @@ class ExampleMain(WebMain):
         self.add_module(reboot_if_network_is_broken)
 
         # Add any common static content (files or dirs).
-        self.add_static("/favicon.ico")
+        # Browsers may cache for max_age seconds; by default they revalidate.
+        self.add_static("/favicon.ico", max_age = 86400)
         self.add_static("/static-pages")
 
         # Add the default front page to another uri, if you wish.
         self.add_module(self, uri = "/WebMain")
 
         # Add a module with default uri (which is "/" + __name__).
-        self.add_module(WebFileManager())
+        # This one is imported on the first request and unloaded after
+        # 10 minutes without requests, to save RAM.
+        self.add_module("WebFileManager:WebFileManager", unload_after = 600_000)
 
         # Try to add own modules; log error on failure.
         # The server will run even if the module is broken.
@@ -83,9 +91,9 @@ class ExampleMain(WebMain):
             # so if you use "/", make sure it's the last one.
             self.add_module(ExampleModule(), uri = "/")
         except BaseException as e:
-            # Log the error and show log file as "front page".
+            # Log the error and show recent log as "front page".
             self._log(e)
-            self.add_static("/WebMain.log", uri = "/")
+            self.add_module(self.logger, uri = "/")
 
 # Start the web server.
 ExampleMain.main()
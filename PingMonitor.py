@@ -0,0 +1,198 @@
+"""Ping many hosts over one ICMP socket and keep RTT statistics.
+
+monitor = PingMonitor(["192.168.0.1", "8.8.8.8"], interval = 1000)
+while True:
+    monitor.update()
+    sent, lost, rtt_min, rtt_avg, rtt_max, jitter = monitor.add("8.8.8.8").stats()
+
+As a WebMain module, background ticks drive update() and requests get a
+table of the statistics.
+"""
+
+import socket, struct, time
+from array import array
+from Checksum import checksum
+from SimpleDNS import resolve
+
+LOST = 0xffff
+
+class PingHost:
+    """One monitored host; the last len(rtt) pings are kept in a ring."""
+
+    def __init__(self, name, ident, history):
+        self.name = name
+        self.ident = ident
+        self.address = None
+        self.rtt = array("H", [LOST] * history)
+        self.sent_at = array("I", [0] * history)
+        self.seq = 0
+        self.clear()
+
+    def clear(self):
+        """Forget the history, e.g. after reconnecting."""
+        self.first = self.seq + 1
+        self.sent = self.received = 0
+
+    def _last_settled(self, timeout):
+        # Latest sequence number that has a reply or has timed out.
+        i = self.seq % len(self.rtt)
+        if self.seq >= self.first and self.rtt[i] == LOST:
+            if time.ticks_diff(time.ticks_ms(), self.sent_at[i]) <= timeout:
+                return self.seq - 1
+        return self.seq
+
+    def in_flight(self, timeout):
+        return self._last_settled(timeout) != self.seq
+
+    def stats(self, timeout):
+        """(sent, lost, min, avg, max, jitter) over the ring; ms, None without replies."""
+        last = self._last_settled(timeout)
+        n = lost = total = jitter = jitter_n = 0
+        low = high = previous = None
+        for seq in range(max(self.first, last - len(self.rtt) + 1), last + 1):
+            rtt = self.rtt[seq % len(self.rtt)]
+            n += 1
+            if rtt == LOST:
+                lost += 1
+                continue
+            total += rtt
+            low = rtt if low is None or rtt < low else low
+            high = rtt if high is None or rtt > high else high
+            if previous is not None:
+                jitter += abs(rtt - previous)
+                jitter_n += 1
+            previous = rtt
+        return (
+            n, lost, low, total // (n - lost) if n > lost else None, high,
+            jitter // jitter_n if jitter_n else None,
+        )
+
+    def lost_in_row(self, timeout):
+        """Number of latest pings without a reply."""
+        lost = 0
+        seq = self._last_settled(timeout)
+        while seq >= max(self.first, self.seq - len(self.rtt) + 1) and self.rtt[seq % len(self.rtt)] == LOST:
+            lost += 1
+            seq -= 1
+        return lost
+
+class PingMonitor:
+    def __init__(self, hosts = (), interval = 1_000, timeout = 1_000, history = 16, ping_size = 64):
+        self.interval = interval
+        self.timeout = timeout
+        self.history = history
+        self.hosts = []
+        self.socket = None
+        self.broken = False
+        # Echo id of host i is base + i, so replies map straight to hosts.
+        self._ident = time.ticks_us() & 0xff00
+        self._tx = bytearray(ping_size)
+        self._rx = bytearray(60 + ping_size)
+        self._next = time.ticks_ms()
+        for host in hosts:
+            self.add(host)
+
+    def add(self, name):
+        """Start monitoring a host (name or IP); returns its PingHost."""
+        for host in self.hosts:
+            if host.name == name:
+                return host
+        host = PingHost(name, (self._ident + len(self.hosts)) & 0xffff, self.history)
+        self.hosts.append(host)
+        return host
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def _open(self):
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, 1)
+            self.socket.setblocking(False) # select.poll returns POLLHUP with SOCK_RAW.
+            return True
+        except OSError as e:
+            self.close()
+            if e.errno == 12: # ENOMEM
+                self.broken = True
+
+    def _ping(self, host):
+        if not host.address:
+            host.address = resolve(host.name, 1)
+            if not host.address:
+                return # Still resolving, or no such host.
+        host.seq += 1
+        host.sent += 1
+        i = host.seq % len(host.rtt)
+        host.rtt[i] = LOST
+        host.sent_at[i] = now = time.ticks_ms()
+        packet = self._tx
+        struct.pack_into("!BBHHHI", packet, 0, 8, 0, 0, host.ident, host.seq & 0xffff, now)
+        struct.pack_into("!H", packet, 2, checksum(packet))
+        if not self.socket:
+            return # Could not open one (see broken); counts as lost.
+        try:
+            self.socket.sendto(packet, host.address)
+            self.broken = False
+        except OSError as e:
+            if e.errno == 12: # ENOMEM
+                self.broken = True
+            # Otherwise mostly EHOSTUNREACH (113); counts as lost.
+
+    def _pong(self):
+        rx = self._rx
+        try:
+            n = self.socket.readinto(rx)
+        except OSError:
+            return False
+        if not n:
+            return False
+        i = (rx[0] & 0x0f) * 4 # IP header length
+        if n < i + 8 or rx[i] != 0: # Echo reply
+            return True
+        index = ((rx[i + 4] << 8) | rx[i + 5]) - self._ident
+        if not 0 <= index < len(self.hosts):
+            return True
+        host = self.hosts[index]
+        back = (host.seq - ((rx[i + 6] << 8) | rx[i + 7])) & 0xffff
+        if back >= len(host.rtt) or host.seq - back < host.first:
+            return True
+        slot = (host.seq - back) % len(host.rtt)
+        rtt = time.ticks_diff(time.ticks_ms(), host.sent_at[slot])
+        if host.rtt[slot] == LOST and rtt <= self.timeout:
+            host.rtt[slot] = rtt or 1 # Like SimplePing, never zero.
+            host.received += 1
+        return True
+
+    def update(self):
+        """Send due pings and read replies; returns ms until another update is useful."""
+        due = time.ticks_diff(time.ticks_ms(), self._next) >= 0
+        if not self.socket and due:
+            self._open()
+        while self.socket and self._pong():
+            continue
+        if due:
+            # Without a socket the pings still count, as lost, so that
+            # lost_in_row() notices an interface that is out of memory.
+            self._next = time.ticks_add(time.ticks_ms(), self.interval)
+            for host in self.hosts:
+                self._ping(host)
+        for host in self.hosts:
+            if self.socket and host.in_flight(self.timeout):
+                return 10
+        return max(0, time.ticks_diff(self._next, time.ticks_ms()))
+
+    def __call__(self, request):
+        # Support WebMain module interface.
+        delay = self.update()
+        if not request:
+            return delay
+        if request.path_info not in ("", "?"):
+            return
+        request.reply(mime = b"text/html; charset=UTF-8")
+        request.reply(b"<!DOCTYPE html><title>PingMonitor</title><table>"
+            b"<tr><th>host<th>sent<th>lost<th>min ms<th>avg ms<th>max ms<th>jitter ms")
+        for host in self.hosts:
+            s = host.stats(self.timeout)
+            request.reply(f"<tr><td>{host.name}<td>{s[0]}<td>{s[1]}<td>{s[2]}<td>{s[3]}<td>{s[4]}<td>{s[5]}")
+        request.reply(b"</table>")
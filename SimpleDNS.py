@@ -0,0 +1,145 @@
+"""Very simplified non-blocking DNS resolver with a cache."""
+
+import socket, struct, time
+from Timeout import Timeout
+
+def _is_ip(name):
+    parts = name.split(".")
+    return len(parts) == 4 and all(p.isdigit() for p in parts)
+
+def _skip_name(msg, i):
+    while msg[i]:
+        if msg[i] & 0xc0 == 0xc0:
+            return i + 2
+        i += msg[i] + 1
+    return i + 1
+
+class SimpleDNS:
+    """Resolve names without blocking
+
+    address = resolver.resolve("pool.ntp.org", 123)
+    # ("1.2.3.4", 123) when known, None while the query is in flight
+    # (call again later), False if the name does not resolve.
+
+    Answers are cached for their TTL, failures for negative_ttl, and
+    concurrent lookups of one name share a query. Without a server,
+    socket.getaddrinfo is used instead (blocking, not cached).
+    """
+
+    def __init__(self, server = None, timeout = 2_000, retries = 2, negative_ttl = 30_000, max_ttl = 86400_000, max_entries = 16, port = 53):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self.socket = None
+        self._cache = {}
+        self._pending = {}
+        self._id = time.ticks_us() & 0xffff
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+        self._pending = {}
+
+    def _store(self, name, ip, ttl):
+        if name not in self._cache and len(self._cache) >= self.max_entries:
+            now = time.ticks_ms()
+            del self._cache[min(self._cache, key = lambda k: time.ticks_diff(self._cache[k][1], now))]
+        self._cache[name] = (ip, time.ticks_add(time.ticks_ms(), max(1_000, ttl)))
+
+    def _send(self, name, ident):
+        q = bytearray(struct.pack("!HHHHHH", ident, 0x0100, 1, 0, 0, 0)) # Recursion desired, 1 question.
+        for label in name.split("."):
+            q.append(len(label))
+            q.extend(label.encode())
+        q.extend(b"\0\0\1\0\1") # Type A, class IN
+        try:
+            self.socket.sendto(q, (self.server, self.port))
+        except OSError:
+            pass # Retried on timeout.
+
+    def _query(self, name):
+        if name in self._pending:
+            return
+        if not self.socket:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setblocking(False)
+        self._id = (self._id + 1) & 0xffff
+        self._pending[name] = [self._id, Timeout(self.timeout), 0]
+        self._send(name, self._id)
+
+    def _answer(self, msg):
+        ident, flags, qd, an = struct.unpack_from("!HHHH", msg)
+        for name, p in self._pending.items():
+            if p[0] == ident:
+                break
+        else:
+            return
+        del self._pending[name]
+        ip, ttl = None, self.negative_ttl
+        if flags & 0x800f == 0x8000: # Response, no error
+            i = 12
+            for _ in range(qd):
+                i = _skip_name(msg, i) + 4
+            for _ in range(an):
+                i = _skip_name(msg, i)
+                rtype, rclass, rttl, size = struct.unpack_from("!HHIH", msg, i)
+                i += 10
+                if rtype == 1 and rclass == 1 and size == 4:
+                    ip = "%d.%d.%d.%d" % tuple(msg[i : i + 4])
+                    ttl = min(rttl * 1000, self.max_ttl)
+                    break
+                i += size
+        self._store(name, ip, ttl)
+
+    def poll(self):
+        """Read answers and retry or give up timed out queries."""
+        while self.socket:
+            try:
+                msg, address = self.socket.recvfrom(512)
+            except OSError:
+                break
+            try:
+                self._answer(msg)
+            except:
+                pass
+        for name, p in list(self._pending.items()):
+            if p[1].expired():
+                if p[2] >= self.retries:
+                    del self._pending[name]
+                    self._store(name, None, self.negative_ttl)
+                else:
+                    p[1], p[2] = Timeout(self.timeout), p[2] + 1
+                    self._send(name, p[0])
+
+    def lookup(self, name):
+        """IP address as a string, None while pending, False on failure."""
+        if _is_ip(name):
+            return name
+        self.poll()
+        entry = self._cache.get(name)
+        if entry:
+            if time.ticks_diff(entry[1], time.ticks_ms()) > 0:
+                return entry[0] or False
+            del self._cache[name]
+        self._query(name)
+        return None
+
+    def resolve(self, name, port):
+        """Socket address for name and port; see lookup for None and False."""
+        if not self.server and not _is_ip(name):
+            try:
+                return socket.getaddrinfo(name, port)[0][-1]
+            except OSError:
+                return False
+        ip = self.lookup(name)
+        return ip and (ip, port)
+
+resolver = SimpleDNS()
+
+def resolve(name, port):
+    return resolver.resolve(name, port)
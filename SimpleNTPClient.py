@@ -1,7 +1,27 @@
-"""Very simplified NTP implementation."""
+"""Simple SNTP implementation."""
 
 import socket, struct, time, machine
 from Timeout import Timeout
+from SimpleDNS import resolve
+
+NTP_DELTA = 2208988800
+
+# Each pool name resolves to a different server, so these are queried in parallel.
+NTP_POOL = ("0.pool.ntp.org", "1.pool.ntp.org", "2.pool.ntp.org")
+
+def _local_ms():
+    # Local clock (RTC) in Unix milliseconds.
+    try:
+        return time.time_ns() // 1_000_000
+    except AttributeError:
+        return time.time() * 1000 + 500 # Whole seconds only; centre the error.
+
+def _ntp_ms(msg, offset):
+    s, f = struct.unpack_from("!II", msg, offset)
+    # TODO: NTP timestamp will overflow in 2036; apply temporary fix for another 100 years.
+    if s < 3870000000:
+        s += 2**32
+    return (s - NTP_DELTA) * 1000 + (f * 1000 >> 32)
 
 class SimpleNTPClient:
     """Query NTP
@@ -15,51 +35,111 @@ class SimpleNTPClient:
     while not ntp.done():
         do_other_stuff()
     time_tuple = ntp.datetime()
+
+    Several servers may be given as a list (by default, three pool.ntp.org
+    names); they are queried at once and the reply with the shortest round
+    trip wins. After a successful query,
+    offset (server - local clock) and delay are in milliseconds.
     """
 
-    def __init__(self, server = "pool.ntp.org", timeout = 5_000):
+    def __init__(self, server = NTP_POOL, timeout = 5_000, spread = 500, port = 123):
         self.server = server
         self.timeout = Timeout(timeout)
+        self.spread = spread
         self.result = None
+        self.offset = self.delay = self.source = None
+        self.port = port
+        self._sent = {}
+        self._settle = None
+        self._resolving = list(enumerate((server,) if isinstance(server, str) else server))
+        self._packet = bytearray(48)
+        self._packet[0] = 0x1b # LI 0, version 3, mode 3 (client)
         try:
-            address = socket.getaddrinfo(self.server, 123)[0][-1]
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.socket.setblocking(False)
-            self.socket.sendto(b'\x1b' + 47 * b'\0', address)
         except:
             self.socket = None
+            return
+        self._send()
+        if not self._sent and not self._resolving:
+            self.close()
+
+    def _send(self):
+        # Query each server as soon as its name is resolved.
+        packet = self._packet
+        for item in self._resolving[:]:
+            i, server = item
+            address = resolve(server, self.port)
+            if address is None:
+                continue
+            self._resolving.remove(item)
+            if not address:
+                continue
+            try:
+                t1 = _local_ms()
+                # Transmit timestamp; the server echoes it back as the originate timestamp.
+                s, ms = divmod(t1, 1000)
+                struct.pack_into("!II", packet, 40, (s + NTP_DELTA) & 0xffffffff, (ms << 32) // 1000 & ~0xff | i)
+                self.socket.sendto(packet, address)
+                self._sent[bytes(packet[40:48])] = (server, t1, time.ticks_ms())
+            except:
+                pass
 
     def close(self):
         if self.socket:
             self.socket.close()
             self.socket = None
 
+    def _sample(self, msg):
+        # RFC 4330: offset = ((T2 - T1) + (T3 - T4)) / 2, delay = (T4 - T1) - (T3 - T2).
+        if len(msg) < 48 or msg[0] & 7 != 4 or msg[0] >> 6 == 3 or not 0 < msg[1] < 16:
+            return
+        sent = self._sent.pop(bytes(msg[24:32]), None)
+        if not sent:
+            return
+        server, t1, ticks = sent
+        t2, t3 = _ntp_ms(msg, 32), _ntp_ms(msg, 40)
+        now = time.ticks_ms()
+        t4 = t1 + time.ticks_diff(now, ticks)
+        delay = (t4 - t1) - (t3 - t2)
+        if self.delay is None or delay < self.delay:
+            self.offset = ((t2 - t1) + (t3 - t4)) // 2
+            self.delay = max(0, delay)
+            self.source = server
+            self._ms = t4 + self.offset
+            self._ticks = now
+        self._settle = self._settle or Timeout(self.spread)
+
     def _recv(self):
-        try:
-            msg, address = self.socket.recvfrom(17 * 4)
-            self.close()
-        except:
-            if self.timeout.expired():
-                self.close()
+        self._resolving and self._send()
+        while True:
+            try:
+                msg, address = self.socket.recvfrom(17 * 4)
+            except:
+                break
+            try:
+                self._sample(msg)
+            except:
+                pass
+        if (self._sent or self._resolving) and not self.timeout.expired() and not (self._settle and self._settle.expired()):
             return
-        try:
-            t = struct.unpack_from("!I", msg, 40)[0] or None
-            # TODO: NTP timestamp will overflow in 2036; apply temporary fix for another 100 years.
-            if t < 3870000000:
-                t += 2**32
-            # TODO: time.localtime will overflow in 2038; just hope that MicroPython has it fixed by then.
-            t = time.localtime(t - 2208988800)
-            # TODO: Check sane result compared to RTC
-            self.result = (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
-        except:
-            self.result = False
+        self.close()
+        self.result = self.delay is not None
         return True
 
     def done(self):
         return not self.socket or self._recv()
 
+    def ms(self):
+        """Current Unix time in milliseconds according to the query."""
+        return self._ms + time.ticks_diff(time.ticks_ms(), self._ticks)
+
     def datetime(self):
-        return self.done() and self.result
+        if not (self.done() and self.result):
+            return self.result
+        # TODO: time.localtime will overflow in 2038; just hope that MicroPython has it fixed by then.
+        t = time.localtime(self.ms() // 1000)
+        return (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
 
     def wait(self, any = False):
         while not self.done():
@@ -67,25 +147,49 @@ class SimpleNTPClient:
         return self.datetime()
 
 class WebSyncRTC:
-    def __init__(self, server = "pool.ntp.org", interval = 86400_000):
+    """Keep RTC in time. The interval is doubled while the clock stays
+    within max_error / 2 ms and halved when it drifts more than max_error."""
+
+    def __init__(self, server = NTP_POOL, interval = 86400_000, min_interval = 3600_000, max_interval = 3 * 86400_000, max_error = 500):
         self.server = server
         self.interval = interval
+        self.min_interval, self.max_interval = min_interval, max_interval
+        self.max_error = max_error
         self.timer = Timeout(-1)
         self.ntp = None
         self.synced = None
+        self.drift = None
+        self._synced_ms = None
+
+    def _sync(self, ntp):
+        if self._synced_ms is not None:
+            self.drift = ntp.offset * 1_000_000 // max(1, ntp.ms() - self._synced_ms) # ppm
+            if abs(ntp.offset) <= self.max_error // 2:
+                self.interval = min(self.interval * 2, self.max_interval)
+            elif abs(ntp.offset) > self.max_error:
+                self.interval = max(self.interval // 2, self.min_interval)
+        t = ntp.datetime()
+        machine.RTC().datetime(t)
+        self._synced_ms = ntp.ms()
+        self.timer = Timeout(self.interval)
+        self.synced = "{0:04}-{1:02}-{2:02}T{3:02}:{4:02}:{5:02}Z".format(*t[0:3], *t[4:7])
+        print(f"NTP synced: {self.synced}, offset {ntp.offset} ms, delay {ntp.delay} ms, from {ntp.source}")
 
     def __call__(self, request):
         # Support WebMain module interface.
         self.ntp = self.ntp or (self.timer.expired() and SimpleNTPClient(self.server))
         if self.ntp and self.ntp.done():
-            t = self.ntp.datetime()
-            self.ntp = None
-            if t:
-                machine.RTC().datetime(t)
-                self.timer = Timeout(self.interval)
-                self.synced = "{0:04}-{1:02}-{2:02}T{3:02}:{4:02}:{5:02}Z".format(*t[0:3], *t[4:7])
-                print(f"NTP synced: {self.synced}")
-            else:
+            if not self.ntp.result:
+                self.ntp = None
                 self.timer = Timeout(10_000)
+            elif self.ntp.ms() % 1000 < 50:
+                # RTC has whole seconds; set it right after a second starts.
+                self._sync(self.ntp)
+                self.ntp = None
         if request and not request.path_info:
-            request.reply(f"Last NTP sync: {self.synced}, from {self.server}, interval {self.interval} ms")
+            request.reply(f"Last NTP sync: {self.synced}, from {self.server}, interval {self.interval} ms, drift {self.drift} ppm")
+        if not request:
+            # Tell WebMain when to call again: poll often while a query is in flight.
+            if self.ntp and self.ntp.done():
+                return 1000 - self.ntp.ms() % 1000
+            return 20 if self.ntp else self.timer.remaining()
@@ -2,15 +2,8 @@
 
 import socket, struct, time
 from Timeout import Timeout
-
-def checksum(data):
-    """Internet checksum"""
-    s = 0
-    for i in range(len(data)):
-        s += data[i] << (0 if i & 1 else 8)
-        if s > 0xffff:
-            s -= 0xffff
-    return s ^ 0xffff
+from Checksum import checksum
+from SimpleDNS import resolve
 
 class SimplePing:
     """Ping a host
@@ -42,8 +35,10 @@ class SimplePing:
         self._ping()
 
     def _connect(self):
+        address = resolve(self.host, 1)
+        if not address:
+            return # Still resolving, or no such host.
         try:
-            address = socket.getaddrinfo(self.host, 1)[0][-1]
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, 1)
             self.socket.setblocking(False) # select.poll returns POLLHUP with SOCK_RAW.
             self.socket.connect(address)
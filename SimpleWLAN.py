@@ -1,6 +1,7 @@
 import network, os, machine
 from Timeout import Timeout
-from SimplePing import SimplePing
+from PingMonitor import PingMonitor
+import SimpleDNS
 
 class SimpleWLAN:
     """Connect to WLAN: x = SimpleWLAN("ssid", "key", ap = False)"""
@@ -11,7 +12,8 @@ class SimpleWLAN:
             self.ssid = (os.uname()[0] + "-" + "".join("%02x" % i for i in machine.unique_id()))[:32]
         self.wlan = None
         self._keepalive_ping = keepalive_ping
-        self._ping = None
+        self.ping = PingMonitor(interval = 10_000, timeout = 10_000)
+        self._gateway_ping = None
         self._ping_broken = 0
         self.connect()
 
@@ -33,9 +35,8 @@ class SimpleWLAN:
         return self(**conf)
 
     def disconnect(self):
-        if self._ping:
-            self._ping.close()
-            self._ping = None
+        self.ping.close()
+        SimpleDNS.resolver.close()
         if self.wlan:
             self.wlan.disconnect()
             self.wlan.active(False)
@@ -66,7 +67,14 @@ class SimpleWLAN:
             if not self.ip:
                 x = self.wlan.ifconfig()
                 self.ip, self.gateway = x[0], x[2]
+                if x[3] != "0.0.0.0":
+                    SimpleDNS.resolver.server = x[3]
                 print(f"WLAN ready, IP {self.ip}, gateway {self.gateway}")
+                if not self._gateway_ping:
+                    self._gateway_ping = self.ping.add(self.gateway)
+                elif self._gateway_ping.name != self.gateway:
+                    self._gateway_ping.name, self._gateway_ping.address = self.gateway, None
+                self._gateway_ping.clear()
             if self._keepalive_ping:
                 return self._ping_or_reconnect()
             return True
@@ -77,15 +85,12 @@ class SimpleWLAN:
         return False
 
     def _ping_or_reconnect(self):
-        if self._ping and self._ping.done() and self._ping.ms():
-            self._ping = None
+        self.ping.update()
+        if self._gateway_ping.received:
             self._ping_broken = 0
-        if not self._ping:
-            self._ping = SimplePing(self.gateway, count = 7, interval = 10_000, timeout = 10_000)
+        if self._gateway_ping.lost_in_row(self.ping.timeout) < 7:
             return True
-        if not self._ping.done():
-            return True
-        if self._ping.broken:
+        if self.ping.broken:
             self._ping_broken += 1
         print(f"PING failed, reconnecting.")
         self.connect()
@@ -9,3 +9,9 @@ class Timeout:
 
     def expired(self):
         return self.ms and time.ticks_diff(time.ticks_ms(), self.started) > self.ms
+
+    def remaining(self):
+        """Milliseconds until expired, or None if it never expires."""
+        if not self.ms:
+            return None
+        return max(0, self.ms - time.ticks_diff(time.ticks_ms(), self.started) + 1)
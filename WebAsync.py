@@ -0,0 +1,230 @@
+"""Asynchronous serving mode for WebMain: WebMain(network, use_async = True).
+
+Each client gets its own task, so a slow client only waits for its own
+socket instead of stalling everybody else. Module handlers are still plain
+handler(request) calls: output is sent right away if the socket accepts it,
+and queued for the task to drain otherwise. Static files and other
+request.run_task() generators continue after the handler returns, a chunk
+at a time as the client takes them.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+import time
+from WebMain import WebRequest
+
+class AsyncWebRequest(WebRequest):
+    """WebRequest on an asyncio stream; parse, finish and drain are coroutines.
+
+    Handlers are synchronous, so read_body and the other body readers
+    block like in WebRequest, except in run_task() generators. Output that the
+    socket does not take at once is kept in RAM until the task drains it;
+    send big responses with reply_static or through run_task()."""
+
+    def __init__(self, stream = None):
+        self._queue = []
+        super().__init__()
+        if stream:
+            self.attach(stream)
+
+    def attach(self, stream):
+        self.stream = stream
+        self._queue.clear()
+        super().attach(stream.s)
+
+    def detach(self):
+        super().detach()
+        self.stream = None
+
+    def reset(self):
+        super().reset()
+        # In tasks, reads take only what has arrived; _starved if the last got nothing.
+        self._nowait = self._starved = False
+
+    async def _recv_until_async(self, max_size, parse = None, timeout = 2000):
+        while not self._recv_ready(max_size, parse):
+            try:
+                n = await asyncio.wait_for_ms(self.stream.readinto(self._free()), timeout)
+            except asyncio.TimeoutError:
+                return False
+            if not n:
+                return False
+            self._received(n)
+        return True
+
+    async def _recv_more(self):
+        # Wait for input beyond what is buffered (say, the rest of a chunk size line).
+        if not await self._recv_until_async(self._end - self._start + 1):
+            raise RuntimeError("Client disconnected or timed out.")
+
+    def _recv_nowait(self, mem):
+        try:
+            return self.socket.readinto(mem)
+        except OSError:
+            return None # EAGAIN
+
+    def _recv_until(self, max_size, parse = None, timeout = 2000):
+        if not self._nowait:
+            return super()._recv_until(max_size, parse, timeout)
+        while not self._recv_ready(max_size, parse):
+            n = self._recv_nowait(self._free())
+            if not n:
+                return n
+            self._received(n)
+        return True
+
+    def _recv_some(self, mem):
+        if not self._nowait:
+            return super()._recv_some(mem)
+        n = self._recv_nowait(mem)
+        if n == 0:
+            raise RuntimeError("Client disconnected.")
+        return n
+
+    def readinto(self, buf):
+        n = super().readinto(buf)
+        self._starved = n is None
+        return n
+
+    def read_body(self, chunk_size = 1024):
+        data = super().read_body(chunk_size)
+        self._starved = data is None
+        return data
+
+    async def parse(self, timeout = 2000):
+        return self._parsed(await self._recv_until_async(self.max_header_size + 1, self._parse_head, timeout))
+
+    async def _read_body_async(self, chunk_size = 1024):
+        self._nowait = True
+        try:
+            while True:
+                data = self.read_body(chunk_size)
+                if data is not None:
+                    return data
+                await self._recv_more()
+        finally:
+            self._nowait = False
+
+    def run_task(self, task):
+        self._capture = None
+        self._tasks.append(task)
+
+    def _send(self, data):
+        self.output_started = True
+        mem = memoryview(data)
+        if not self._queue:
+            try:
+                sent = self.socket.send(mem)
+                self.bytes_out += sent
+                mem = mem[sent:]
+            except OSError:
+                pass # Mostly EAGAIN; queue it.
+        if len(mem):
+            self._queue.append(bytes(mem))
+
+    def _sendfile(self, f, start, end):
+        return False # It would wait for the socket; _send_file yields instead.
+
+    async def finish(self):
+        self.flush(True)
+        await self.drain()
+        if not self.body_done() and (self._chunk_left is not None or self.size - self._body_pos > 4096):
+            self.keep_alive = False
+        while self.keep_alive and not self.body_done() and await self._read_body_async():
+            pass
+        return self.keep_alive
+
+    async def drain(self):
+        stream = self.stream
+        started = time.ticks_us()
+        while self._queue:
+            data = self._queue.pop(0)
+            self.bytes_out += len(data)
+            stream.write(data)
+            await asyncio.wait_for_ms(stream.drain(), 2000)
+        self.send_us += time.ticks_diff(time.ticks_us(), started)
+
+async def _run_tasks(main, request):
+    # Run the tasks from run_task(), waiting for the client whenever they yield.
+    # Errors in a task are answered like handler errors; losing the client ends _serve.
+    while request._tasks:
+        task = request._tasks.pop(0)
+        request._nowait = True
+        try:
+            while True:
+                try:
+                    next(task)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    main._fail(request, e, 500, b"Failed to process request")
+                    break
+                waited = request._queue or request._starved
+                await request.drain()
+                if request._starved:
+                    request._starved = False
+                    await request._recv_more()
+                if not waited:
+                    await asyncio.sleep_ms(0)
+        finally:
+            request._nowait = request._starved = False
+            task.close()
+    if not request.output_started:
+        request.reply(status = 404, content = b"Not found")
+
+async def _serve(main, stream):
+    request = main._take_request(AsyncWebRequest, stream)
+    if not request:
+        main._refuse(stream.s)
+        stream.close()
+        await stream.wait_closed()
+        return
+    try:
+        for i in range(main.keep_alive_max):
+            request.reset()
+            try:
+                if not await request.parse(main.keep_alive_timeout if i else 2000):
+                    break
+            except BaseException as e:
+                main._fail(request, e, 401, b"Failed to parse request")
+                await request.drain()
+                break
+            times = main._process(request)
+            await _run_tasks(main, request)
+            try:
+                keep_alive = await request.finish()
+            finally:
+                main._record(request, times)
+            if not keep_alive:
+                break
+    except Exception:
+        pass
+    finally:
+        # Upgraded connections (WebSocket) have been detached from the request.
+        if request.socket:
+            stream.close()
+            await stream.wait_closed()
+        main._release_request(request)
+
+async def _main(main):
+    server = None
+    network_check = 0
+    try:
+        while True:
+            now = main._now()
+            if now >= network_check:
+                if main.network.connected() and not server:
+                    print(f"Starting HTTP server http://{main.network.ip}/ (async)")
+                    server = await asyncio.start_server(lambda stream, _: _serve(main, stream), "0.0.0.0", 80, 4)
+                network_check = now + main.network_interval
+            main._run_due(now)
+            main._run_queued()
+            await asyncio.sleep_ms(max(0, min(main._next_deadline(), network_check) - main._now()))
+    finally:
+        if server:
+            server.close()
+
+def run(main):
+    asyncio.run(_main(main))
@@ -0,0 +1,64 @@
+"""Response cache for WebMain: WebMain(network, cache_size = bytes).
+
+Modules opt in with add_module(..., cache_ttl = ms). Their 200 responses
+to GET are kept by method and URI (status, mime, headers and body) and
+replayed until they expire; the least recently used go first when the
+cache would exceed cache_size bytes. When the state behind a page changes,
+call main.invalidate(uri_prefix), or main.invalidate(uri, True) for one
+page, also from background callbacks.
+"""
+
+import time
+from WebThread import allocate_lock
+
+class WebCache:
+    """Cached responses with per-entry expiry and a total byte budget."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self._uses = 0
+        # key -> [expires, last use, size, module, status, mime, headers, body].
+        # Writers replace the whole dict under a lock (like SharedState),
+        # so lookups need no lock in threaded mode.
+        self._lock = allocate_lock()
+        self._entries = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry and time.ticks_diff(entry[0], time.ticks_ms()) > 0:
+            self.hits += 1
+            self._uses += 1
+            entry[1] = self._uses
+            return entry
+        self.misses += 1
+
+    def put(self, key, ttl, module, status, mime, headers, body):
+        size = len(key) + len(headers) + len(body)
+        if size > self.max_bytes:
+            return
+        now = time.ticks_ms()
+        with self._lock:
+            entries = dict(self._entries)
+            replaced = entries.pop(key, None)
+            total = self.size - replaced[2] if replaced else self.size
+            while entries and total + size > self.max_bytes:
+                # Expired entries first, then the least recently used.
+                old = min(entries, key = lambda k: (time.ticks_diff(entries[k][0], now) > 0, entries[k][1]))
+                total -= entries.pop(old)[2]
+            self._uses += 1
+            entries[key] = [time.ticks_add(now, ttl), self._uses, size, module, status, mime, headers, body]
+            self._entries, self.size = entries, total + size
+
+    def invalidate(self, uri = None, exact = False):
+        """Drop entries whose URI starts with (or if exact, is) uri, or all of them."""
+        with self._lock:
+            entries = {}
+            if uri is not None:
+                for key, entry in self._entries.items():
+                    k = key.split(" ", 1)[1]
+                    if not (k == uri if exact else k.startswith(uri)):
+                        entries[key] = entry
+            self._entries = entries
+            self.size = sum(entry[2] for entry in entries.values())
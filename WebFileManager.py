@@ -1,8 +1,90 @@
-import json, machine, os, time
+import io, json, machine, os, select, time
+
+# Tar timestamps count from 1970; some ports count from 2000.
+_EPOCH = 946684800 if time.gmtime(0)[0] == 2000 else 0
+_ZERO = memoryview(bytes(1024))
+
+def _unquote(s):
+    # Percent-decode a query value, as encodeURIComponent wrote it.
+    if "%" not in s:
+        return s
+    parts = s.encode().split(b"%")
+    out = bytearray(parts[0])
+    for i in parts[1:]:
+        try:
+            if len(i) < 2:
+                raise ValueError
+            out.append(int(i[:2], 16))
+            out.extend(i[2:])
+        except ValueError:
+            out.extend(b"%" + i)
+    return out.decode()
+
+def _params(query):
+    # "?a=x&b": {"a": "x", "b": ""}, percent-decoded.
+    return dict(map(_unquote, i.split("=", 1)) if "=" in i else (_unquote(i), "") for i in query[1:].split("&"))
+
+class _Stream(io.IOBase):
+    # Request body and reply as a stream, for deflate.DeflateIO. The body can
+    # be read ahead with fill(), because DeflateIO can't yield to run_task().
+    def __init__(self, request, read_ahead = 0):
+        self.request = request
+        self._buf = bytearray(read_ahead)
+        self._start = self._end = 0
+
+    def fill(self):
+        # False (yield, then call again) until the buffer is full or has the rest of the body.
+        buf, start, end = self._buf, self._start, self._end
+        if start:
+            buf[:end - start] = buf[start:end]
+            self._start, self._end = 0, end - start
+        while self._end < len(buf):
+            n = self.request.readinto(memoryview(buf)[self._end:])
+            if n is None:
+                return False
+            if not n:
+                break
+            self._end += n
+        return True
+
+    def readinto(self, buf):
+        n = min(len(buf), self._end - self._start)
+        if n:
+            buf[:n] = memoryview(self._buf)[self._start:self._start + n]
+            self._start += n
+            return n
+        request = self.request
+        n = request.readinto(buf)
+        while n is None:
+            # Beyond the read-ahead (rare): wait here.
+            if not request._wait(select.POLLIN):
+                raise RuntimeError("Client timed out.")
+            n = request.readinto(buf)
+        return n
+
+    def write(self, data):
+        self.request.reply(data)
+        return len(data)
+
+class _Gunzip:
+    # Gzip request body for WebFileManager._read, 512 bytes at a time with
+    # 1 kB of input read ahead, so that DeflateIO rarely has to wait.
+    def __init__(self, request):
+        import deflate
+        self.raw = _Stream(request, 1024)
+        self.io = deflate.DeflateIO(self.raw, deflate.GZIP)
+
+    def readinto(self, mem):
+        if not self.raw.fill():
+            return None
+        return self.io.readinto(mem[:512])
 
 class WebFileManager:
     """File manager module; remember to include the .html file!"""
 
+    def __init__(self):
+        self._buffers = []
+
     def _try(self, request, action):
         try:
             action()
@@ -11,9 +93,315 @@ class WebFileManager:
         else:
             request.reply(status = 200, content = b"ok")
 
+    def _try_task(self, request, task):
+        # _try for a generator, run with request.run_task().
+        try:
+            yield from task
+        except:
+            request.reply(status = 500, content = b"fail")
+        else:
+            request.reply(status = 200, content = b"ok")
+
+    # Upload buffers, reused; a multiple of the flash block size. Tasks that
+    # run at the same time (asyncio mode) take one each.
+    upload_buffer_size = 4096
+
+    def _take_buffer(self):
+        while self._buffers:
+            buf = self._buffers.pop()
+            if len(buf) == self.upload_buffer_size:
+                return buf
+        return bytearray(self.upload_buffer_size)
+
+    @staticmethod
+    def _read(src, mem):
+        # Fill mem like readinto, yielding while nothing has arrived (see request.run_task).
+        i = 0
+        while i < len(mem):
+            n = src.readinto(mem[i:])
+            if n is None:
+                yield
+            elif not n:
+                break
+            else:
+                i += n
+        return i
+
     def _write(self, name, request):
-        with open(name, "wb") as f:
-            request.request_body_callback(lambda data: f.write(data))
+        def fill(f):
+            content_type = request.header("content-type", "")
+            if content_type.startswith("multipart/form-data"):
+                yield from self._write_multipart(f, request, content_type, buf)
+            else:
+                while True:
+                    n = yield from self._read(request, mem)
+                    if not n:
+                        break
+                    f.write(mem[:n])
+                    yield
+        buf = self._take_buffer()
+        mem = memoryview(buf)
+        try:
+            yield from self._replace(name, fill)
+        finally:
+            self._buffers.append(buf)
+
+    def _replace(self, name, fill):
+        # Write to a temporary file and replace the target only on success.
+        # Uploads can overlap in asyncio mode, so each gets its own.
+        temp = "%s.%x.part" % (name, id(fill))
+        try:
+            with open(temp, "wb") as f:
+                yield from fill(f)
+            try:
+                os.rename(temp, name)
+            except OSError:
+                # Some filesystems (FAT) won't rename over an existing file.
+                os.unlink(name)
+                os.rename(temp, name)
+        except:
+            try:
+                os.unlink(temp)
+            except:
+                pass
+            raise
+
+    def _write_multipart(self, f, request, content_type, buf):
+        # Stream the first part that has a filename into f.
+        boundary = content_type.split("boundary=", 1)[1].split(";")[0].strip().strip('"')
+        delimiter = b"\r\n--" + boundary.encode()
+        keep = len(delimiter) + 4
+        mem = memoryview(buf)
+        # Start with CRLF so that the first boundary looks like the others.
+        buf[0:2] = b"\r\n"
+        n, scan, eof, writing = 2, 0, False, None
+        while True:
+            if n < len(buf) and not eof:
+                got = yield from self._read(request, mem[n:])
+                eof = n + got < len(buf)
+                n += got
+            # Only mem[scan:n] may hold a delimiter that has not been seen yet.
+            data = bytes(mem[scan:n])
+            i = data.find(delimiter)
+            if writing is None:
+                # Looking for the next part: delimiter, headers, blank line.
+                start = i + len(delimiter)
+                if i >= 0 and data[start:start + 2] == b"--":
+                    raise ValueError("No file in multipart body")
+                j = data.find(b"\r\n\r\n", start) if i >= 0 else -1
+                if j >= 0:
+                    writing = b"filename=" in data[start:j].lower()
+                    cut = scan + j + 4
+                elif eof or (scan + i == 0 and n == len(buf)):
+                    raise ValueError("Bad multipart body")
+                else:
+                    cut = scan + i if i >= 0 else max(0, n - keep)
+            elif i >= 0:
+                if writing:
+                    f.write(mem[:scan + i])
+                    return
+                writing, cut = None, scan + i
+            elif eof:
+                raise ValueError("Unterminated multipart body")
+            else:
+                # Keep a tail that may hold the start of the delimiter.
+                cut = max(0, n - keep)
+                if writing:
+                    f.write(mem[:cut])
+                    yield
+            del data
+            scan = 0 if i >= 0 else max(0, n - len(delimiter) + 1 - cut)
+            self._shift(buf, mem, cut, n)
+            n -= cut
+
+    @staticmethod
+    def _shift(buf, mem, cut, n):
+        # Move buf[cut:n] to the front, in pieces that don't overlap.
+        i = 0
+        while cut and cut + i < n:
+            m = min(cut, n - cut - i)
+            buf[i:i + m] = mem[cut + i:cut + i + m]
+            i += m
+
+    # Entries per ?tree= response; the client continues from "next".
+    tree_page_size = 100
+
+    def _walk(self, path, depth, after):
+        # Depth-first (path, is_dir, size); depth 0 is unlimited. Entries up to
+        # and including the path after are skipped without listing their subtrees;
+        # KeyError if after is no longer there.
+        for i in os.ilistdir(path[:-1] or "/"):
+            name = path + i[0]
+            is_dir = i[1] == 0x4000
+            if is_dir:
+                name += "/"
+            inner = after
+            if after is None:
+                yield name, is_dir, 0 if is_dir else i[3] if len(i) > 3 else os.stat(name)[6]
+            elif after == name:
+                after = inner = None
+            elif is_dir and after.startswith(name):
+                after = None
+            else:
+                continue
+            if is_dir and depth != 1:
+                yield from self._walk(name, depth - 1 if depth else 0, inner)
+        if after is not None:
+            raise KeyError(after)
+
+    def _tree(self, request, params):
+        # ?tree=/dir/&depth=2&after=/dir/x: [path, "d" or "f", size] entries, streamed.
+        path = params["tree"] or "/"
+        if not path.endswith("/"):
+            path += "/"
+        try:
+            os.stat(path[:-1] or "/")
+            depth = int(params.get("depth", 0))
+        except:
+            return request.reply(status = 404)
+        limit = int(params.get("limit", self.tree_page_size))
+        entries = self._walk(path, depth, params.get("after") or None)
+        try:
+            entry = next(entries, None)
+        except KeyError:
+            # The cursor was renamed or removed since the last page; start over.
+            return request.reply(status = 409)
+        request.reply(b'{"entries": [', mime = b"application/json")
+        n, last = 0, None
+        while entry:
+            if n == limit:
+                break
+            name, is_dir, size = entry
+            request.reply('%s[%s, "%s", %d]' % ("," if n else "", json.dumps(name), "d" if is_dir else "f", size))
+            n, last = n + 1, name
+            entry = next(entries, None)
+        else:
+            last = None
+        request.reply('], "next": %s}' % json.dumps(last))
+
+    def _tar(self, request, params):
+        # ?tar=/dir/[&gzip]: the directory as a tar file, generated on the fly.
+        root = params["tar"] or "/"
+        if not root.endswith("/"):
+            root += "/"
+        try:
+            os.stat(root[:-1] or "/")
+        except:
+            return request.reply(status = 404)
+        out = _Stream(request)
+        if "gzip" in params:
+            try:
+                import deflate
+            except ImportError:
+                return request.reply(status = 501, content = b"No deflate module")
+            out = deflate.DeflateIO(out, deflate.GZIP)
+        name = (root.rstrip("/").rsplit("/", 1)[-1] or "root") + (".tar.gz" if "gzip" in params else ".tar")
+        request.reply(mime = b"application/gzip" if "gzip" in params else b"application/x-tar",
+            headers = f'Content-Disposition: attachment; filename="{name}"\r\n'.encode())
+        request.run_task(self._tar_files(root, out, "gzip" in params))
+
+    def _tar_files(self, root, out, gz):
+        header = bytearray(512)
+        buf = self._take_buffer()
+        mem = memoryview(buf)
+        try:
+            for path, is_dir, size in self._walk(root, 0, None):
+                size = 0 if is_dir else size
+                if not self._tar_header(header, path[len(root):], size, os.stat(path)[8] + _EPOCH, is_dir):
+                    continue
+                out.write(header)
+                yield
+                if is_dir:
+                    continue
+                left = size
+                with open(path, "rb") as f:
+                    while left > 0:
+                        n = f.readinto(mem[:min(len(buf), left)])
+                        if not n:
+                            break
+                        out.write(mem[:n])
+                        left -= n
+                        yield
+                # Pad to the size in the header (even if the file shrank) and to the block.
+                left += -size % 512
+                while left > 0:
+                    out.write(_ZERO[:min(left, len(_ZERO))])
+                    left -= len(_ZERO)
+            out.write(_ZERO)
+            if gz:
+                out.close()
+        finally:
+            self._buffers.append(buf)
+
+    @staticmethod
+    def _tar_header(header, name, size, mtime, is_dir):
+        # ustar header; names up to 100 bytes, or 255 split at a slash.
+        name = name.encode()
+        prefix = b""
+        if len(name) > 100:
+            i = name.find(b"/", len(name) - 101)
+            if i < 0 or i > 155:
+                return False
+            prefix, name = name[:i], name[i + 1:]
+        header[:] = _ZERO[:512]
+        header[0:len(name)] = name
+        header[100:108] = b"%07o\0" % (0o755 if is_dir else 0o644)
+        header[108:124] = b"0000000\x000000000\0"
+        header[124:136] = b"%011o\0" % size
+        header[136:148] = b"%011o\0" % mtime
+        header[148:156] = b"        "
+        header[156] = ord("5" if is_dir else "0")
+        header[257:265] = b"ustar\x0000"
+        header[345:345 + len(prefix)] = prefix
+        header[148:156] = b"%06o\0 " % sum(header)
+        return True
+
+    def _untar(self, root, request, gz):
+        # Extract each file to a temporary file and replace the target when complete.
+        root = (root or "/").rstrip("/") + "/"
+        src = _Gunzip(request) if gz else request
+        header = bytearray(512)
+        buf = self._take_buffer()
+        mem = memoryview(buf)
+        def copy(left, f = None):
+            while left > 0:
+                n = min(left, len(buf))
+                if (yield from self._read(src, mem[:n])) < n:
+                    raise ValueError("truncated tar")
+                if f:
+                    f.write(mem[:n])
+                left -= n
+                yield
+        try:
+            while (yield from self._read(src, memoryview(header))) == 512 and header[0]:
+                checksum = int(bytes(header[148:156]).strip(b"\0 ") or b"0", 8)
+                header[148:156] = b"        "
+                if sum(header) != checksum:
+                    raise ValueError("tar checksum")
+                name = bytes(header[0:100]).split(b"\0")[0]
+                prefix = bytes(header[345:500]).split(b"\0")[0]
+                name = (prefix + b"/" + name if prefix else name).decode()
+                size = int(bytes(header[124:136]).strip(b"\0 ") or b"0", 8)
+                padded = size + (-size % 512)
+                parts = [i for i in name.split("/") if i and i != "."]
+                kind = header[156]
+                if not parts or ".." in parts or kind not in b"\x00057":
+                    yield from copy(padded) # Unsafe name, link or other special entry.
+                    continue
+                for i in range(len(parts) + (kind == ord("5"))):
+                    try:
+                        os.mkdir((root + "/".join(parts[:i])).rstrip("/"))
+                    except OSError:
+                        pass
+                if kind != ord("5"):
+                    yield from self._replace(root + "/".join(parts), lambda f: copy(size, f))
+                    padded -= size
+                yield from copy(padded)
+            # Consume the end blocks and record padding.
+            while (yield from self._read(src, mem)):
+                pass
+        finally:
+            self._buffers.append(buf)
 
     def __call__(self, request):
         if not request:
@@ -35,14 +423,26 @@ class WebFileManager:
             else:
                 return request.reply(data)
 
+        if method == "GET" and query.startswith("?tree="):
+            return self._tree(request, _params(query))
+
+        if method == "GET" and query.startswith("?tar="):
+            return self._tar(request, _params(query))
+
+        if method == "POST" and query.startswith("?untar="):
+            params = _params(query)
+            gz = "gzip" in params or request.header("content-encoding") == "gzip"
+            return request.run_task(self._try_task(request, self._untar(params["untar"], request, gz)))
+
         if method == "GET" and query.startswith("?read="):
             try:
-                return request.reply_static(query.split("=", 1)[1])
+                # The file itself, even if a .gz of the same name exists.
+                return request.reply_static(query.split("=", 1)[1], precompressed = False)
             except:
                 return
 
         if method == "POST" and query.startswith("?write="):
-            return self._try(request, lambda: self._write(query.split("=", 1)[1], request))
+            return request.run_task(self._try_task(request, self._write(query.split("=", 1)[1], request)))
 
         if method == "POST" and query.startswith("?mkdir="):
             return self._try(request, lambda: os.mkdir(query.split("=", 1)[1]))
@@ -54,7 +454,10 @@ class WebFileManager:
             return self._try(request, lambda: os.unlink(query.split("=", 1)[1]))
 
         if method == "POST" and query.startswith("?reset"):
+            request.keep_alive = False
             request.reply(b"ok")
+            # Replies are buffered; send it before the connection goes away.
+            request.flush(True)
             request.socket.close()
             time.sleep_ms(100)
             machine.reset()
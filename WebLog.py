@@ -0,0 +1,127 @@
+"""Buffered log for WebMain: records go to a RAM ring and reach flash in batches.
+
+The file is rotated by size (WebMain.log, WebMain.log.1, ...). As a WebMain
+module, handler(None) flushes on a timer and requests get the recent tail
+straight from RAM.
+"""
+
+import sys, io, os, time
+from WebThread import allocate_lock
+
+class WebLog:
+    DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+    _names = {10: "DEBUG", 20: "INFO", 30: "WARNING", 40: "ERROR"}
+
+    def __init__(
+        self, path = "WebMain.log",
+        buffer_size = 2048, level = INFO,
+        max_file_size = 16384, generations = 2,
+        flush_interval = 60_000,
+    ):
+        self.path = path
+        self.level = level
+        self.max_file_size = max_file_size
+        self.generations = generations
+        self.flush_interval = flush_interval
+        self._buffer = bytearray(buffer_size)
+        self._pos = 0
+        self._length = 0
+        self._unflushed = 0
+        # Both threads log in threaded mode.
+        self._lock = allocate_lock()
+
+    def log(self, message, level = None):
+        """Log an exception (default ERROR) or a string (default INFO)."""
+        if isinstance(message, BaseException):
+            sys.print_exception(message)
+            text = io.StringIO()
+            sys.print_exception(message, text)
+            message, level = text.getvalue(), level or self.ERROR
+        else:
+            print(message)
+            level = level or self.INFO
+        if level < self.level:
+            return
+        t = time.gmtime()
+        data = ("\n---------\n{0:04}-{1:02}-{2:02}T{3:02}:{4:02}:{5:02}Z ".format(*t)
+            + self._names.get(level, str(level)) + "\n" + message).encode()
+        with self._lock:
+            self._write(data)
+
+    def _write(self, data):
+        size = len(self._buffer)
+        mem = memoryview(data)
+        if len(mem) > size:
+            mem = mem[len(mem) - size:]
+        n = len(mem)
+        if self._unflushed + n > size:
+            # Buffer full: write out before overwriting unflushed records.
+            self._flush()
+        first = min(n, size - self._pos)
+        self._buffer[self._pos:self._pos + first] = mem[:first]
+        self._buffer[0:n - first] = mem[first:]
+        self._pos = (self._pos + n) % size
+        self._length = min(size, self._length + n)
+        self._unflushed += n
+
+    def _slices(self, n):
+        # The last n bytes of the ring, oldest first, as one or two memoryviews.
+        mem = memoryview(self._buffer)
+        start = self._pos - n
+        if start >= 0:
+            return (mem[start:self._pos],)
+        return (mem[len(mem) + start:], mem[:self._pos])
+
+    def _rotate(self):
+        try:
+            if os.stat(self.path)[6] < self.max_file_size:
+                return
+        except OSError:
+            return
+        for i in range(self.generations, 0, -1):
+            old, new = self.path + (f".{i - 1}" if i > 1 else ""), f"{self.path}.{i}"
+            try:
+                os.rename(old, new)
+            except OSError:
+                # Some filesystems (FAT) won't rename over an existing file.
+                try:
+                    os.stat(old)
+                    os.unlink(new)
+                    os.rename(old, new)
+                except OSError:
+                    pass
+        if not self.generations:
+            os.unlink(self.path)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._unflushed:
+            return
+        try:
+            self._rotate()
+            with open(self.path, "ab") as file:
+                for mem in self._slices(self._unflushed):
+                    file.write(mem)
+        except OSError as e:
+            sys.print_exception(e)
+        self._unflushed = 0
+
+    def tail(self):
+        """Recent log text from RAM, oldest first."""
+        with self._lock:
+            return b"".join(self._slices(self._length))
+
+    def __call__(self, request):
+        # Support WebMain module interface.
+        if not request:
+            self.flush()
+            return
+        if request.path_info == "?flush" and request.method == "POST":
+            self.flush()
+            return request.reply(b"ok")
+        if request.path_info not in ("", "?"):
+            return
+        request.reply(self.tail())
@@ -1,112 +1,619 @@
 """Web-based main loop for MicroPython. See Example.py for instructions."""
 
-import socket, select, time, machine, sys, os, gc
+import socket, select, time, machine, sys, os, gc, io, heapq
 from Timeout import Timeout
+from WebLog import WebLog
+from SimpleDNS import resolve
+import WebTemplate
+from WebThread import Queue, SharedState, NoLock, allocate_lock
 
 def utc_time_str():
     return "{0:04}-{1:02}-{2:02}T{3:02}:{4:02}:{5:02}Z".format(*time.gmtime())
 
+def http_date(t):
+    t = time.gmtime(t)
+    return "{0}, {3:02} {2} {1:04} {4:02}:{5:02}:{6:02} GMT".format(
+        ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")[t[6]], t[0],
+        ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")[t[1] - 1],
+        *t[2:6]
+    )
+
+class HTTPError(Exception):
+    """Raise HTTPError(status, message) to answer with an error page."""
+
 class WebRequest:
-    def __init__(self, socket):
+    # Request limits; exceeding them is answered with 414, 431 or 413.
+    max_header_size = 8192
+    max_headers = 32
+    max_body_size = None
+
+    # Each request object has a receive buffer of this size; it grows for a
+    # longer request or header line (up to max_header_size) until detach().
+    receive_buffer_size = 1024
+
+    # Replies are collected here and sent when it fills up or at finish();
+    # a response that fits entirely gets an exact Content-Length.
+    output_buffer_size = 1024
+
+    def __init__(self, socket = None):
+        self.socket = None
+        self._rx = bytearray(self.receive_buffer_size)
+        self._rx_mem = memoryview(self._rx)
+        # Unconsumed input is self._rx[self._start:self._end].
+        self._start = self._end = 0
+        self._poller = select.poll()
+        self._event = None
+        self._out = None
+        self.headers = {}
+        self._tasks = []
+        self.reset()
+        if socket:
+            self.attach(socket)
+
+    def attach(self, socket):
+        """Serve a new connection with this object; see WebMain.request_pool.
+
+        Objects are reused, so handlers must not keep the request or its
+        headers after returning."""
+        socket.setblocking(False)
         self.socket = socket
+        self._event = None
+        self._start = self._end = 0
+        self.reset()
+
+    def detach(self):
+        """Forget the connection (without closing it)."""
+        try:
+            self._poller.unregister(self.socket)
+        except:
+            pass
+        self.socket = self._event = None
+        self._start = self._end = 0
+        if len(self._rx) != self.receive_buffer_size:
+            self._rx = bytearray(self.receive_buffer_size)
+            self._rx_mem = memoryview(self._rx)
+
+    def reset(self):
+        """Prepare for the next request on the same connection."""
         self.output_started = False
-        self._data = bytearray()
+        self.method = self.uri = self.http_version = None
+        self.headers.clear()
+        self._header_count = 0
+        self._head_size = 0
+        self._scan = 0
+        self.keep_alive = False
+        self._head = None
+        self._out_n = 0
+        self._chunked = False
         self._body_pos = 0
+        self._chunk_left = None
+        self.size = 0
+        # Tasks from run_task() waiting to run (only in asyncio mode).
+        self._tasks.clear()
+        # Instrumentation, see WebMetrics.py.
+        self.module = None
+        self.started = None
+        self.bytes_in = self.bytes_out = self.send_us = 0
+        # Reply arguments and content copied for WebCache, when it is not None.
+        self._capture = None
+        self._capture_left = 0
 
-    def _poll(self, event, *, ready, action):
-        socket = self.socket
-        socket.setblocking(False)
-        poller = select.poll()
-        poller.register(socket, event)
-        while not ready():
-            for x in poller.poll(2000):
-                if x[1] & event:
-                    action(socket)
-                    break
+    def _wait(self, event, timeout = 2000):
+        # Wait until the socket is ready for event; close it on timeout.
+        if event != self._event:
+            self._poller.register(self.socket, event)
+            self._event = event
+        for x in self._poller.poll(timeout):
+            if x[1] & event:
+                return True
+        self.socket.close()
+        return False
+
+    def _pending(self):
+        # True if input (e.g. a pipelined request) is buffered or has arrived.
+        return self._start < self._end or self._readable(0)
+
+    def _readable(self, timeout):
+        if self._event != select.POLLIN:
+            self._poller.register(self.socket, select.POLLIN)
+            self._event = select.POLLIN
+        return bool(self._poller.poll(timeout))
+
+    def _free(self):
+        # Free space after the buffered input, moving that to the front if needed.
+        start, end = self._start, self._end
+        if start == end:
+            self._start = self._end = 0
+        elif end == len(self._rx) and start:
+            self._rx[: end - start] = self._rx[start:end]
+            self._start, self._end = 0, end - start
+        return self._rx_mem[self._end:]
+
+    def _received(self, n):
+        self.bytes_in += n
+        self._end += n
+
+    def _recv_ready(self, max_size, parse):
+        return (parse and parse()) or self._end - self._start >= min(max_size, len(self._rx))
+
+    def _recv_until(self, max_size, parse = None, timeout = 2000):
+        # Receive until max_size bytes (or a full buffer) are buffered or parse() is done.
+        while not self._recv_ready(max_size, parse):
+            if not self._wait(select.POLLIN, timeout):
+                return False
+            n = self.socket.readinto(self._free())
+            if n == 0:
+                return False
+            self._received(n or 0)
+        return True
+
+    def parse(self, timeout = 2000):
+        """Read the request head; return False if the client left without sending one."""
+        return self._parsed(self._recv_until(self.max_header_size + 1, self._parse_head, timeout))
+
+    def _parsed(self, done):
+        if done:
+            return True
+        if self._start == self._end and self.method is None:
+            return False
+        raise RuntimeError("Client disconnected or timed out.")
+
+    def _grow(self, size):
+        # A line does not fit: move the buffered input to a bigger buffer.
+        n = self._end - self._start
+        rx = bytearray(size)
+        rx[:n] = self._rx_mem[self._start:self._end]
+        self._rx, self._rx_mem = rx, memoryview(rx)
+        self._start, self._end = 0, n
+
+    def _head_error(self):
+        if self.method is None:
+            return HTTPError(414, b"URI too long")
+        return HTTPError(431, b"Request header too large")
+
+    def _parse_head(self):
+        # Parse and consume the complete lines received so far; True when the head is complete.
+        start = self._start
+        if self.started is None and self._end > start:
+            self.started = time.ticks_us()
+        rest = bytes(self._rx_mem[start:self._end])
+        pos = 0
+        while True:
+            end = rest.find(b"\n", max(pos, self._scan))
+            if end < 0:
+                self._start = start + pos
+                self._scan = len(rest) - pos
+                self._head_size += pos
+                if self._head_size + self._scan > self.max_header_size:
+                    raise self._head_error()
+                if self._scan >= len(self._rx):
+                    self._grow(min(2 * len(self._rx), self.max_header_size + 1))
+                return False
+            if self._head_size + end >= self.max_header_size:
+                raise self._head_error()
+            line = rest[pos:end].decode().rstrip("\r")
+            pos = end + 1
+            if self.method is None:
+                if line:
+                    self.method, self.uri, self.http_version = line.split(" ")
+            elif line:
+                self._header_count += 1
+                if self._header_count > self.max_headers:
+                    raise HTTPError(431, b"Too many request headers")
+                name, value = line.split(":", 1)
+                name, value = name.lower(), value.strip()
+                if name in self.headers:
+                    value = self.headers[name] + ", " + value
+                self.headers[name] = value
             else:
-                socket.close()
+                self._start = start + pos
+                self._scan = 0
+                self._end_head()
+                return True
+
+    def _end_head(self):
+        headers = self.headers
+        self.size = int(headers.get("content-length", 0))
+        if self.max_body_size is not None and self.size > self.max_body_size:
+            raise HTTPError(413, b"Request body too large")
+        encoding = headers.get("transfer-encoding")
+        if encoding:
+            if encoding.lower() != "chunked":
+                raise HTTPError(501, b"Unsupported transfer encoding")
+            # Bytes left in the current chunk; 0 = size line next, -1 = trailer, -2 = done.
+            self._chunk_left = 0
+        connection = headers.get("connection", "").lower()
+        self.keep_alive = connection == "keep-alive" or (self.http_version == "HTTP/1.1" and connection != "close")
+
+    def header(self, name, default = None):
+        """Value of a request header; name in lower case."""
+        return self.headers.get(name, default)
+
+    def accepts_encoding(self, encoding):
+        for item in self.header("accept-encoding", "").split(","):
+            item = item.split(";")
+            if item[0].strip() in (encoding, "*"):
+                return not (len(item) > 1 and item[1].strip() in ("q=0", "q=0.0", "q=0.00", "q=0.000"))
+        return False
+
+    def body_done(self):
+        if self._chunk_left is None:
+            return self._body_pos >= self.size
+        return self._chunk_left == -2
+
+    def _parse_chunk_header(self):
+        # Consume chunk framing from the buffer; True when body data or the end follows.
+        while True:
+            start = self._start
+            i = bytes(self._rx_mem[start:self._end]).find(b"\n")
+            if i < 0:
                 return False
+            line = bytes(self._rx_mem[start:start + i]).strip()
+            self._start = start + i + 1
+            if self._chunk_left == -1:
+                if not line:
+                    self._chunk_left = -2
+                    return True
+            elif line:
+                size = int(line.split(b";")[0], 16)
+                self._chunk_left = size or -1
+                if size:
+                    return True
 
-    def _recv_until(self, max_size, boundary):
-        data = self._data
-        def action(socket):
-            # Receive in chunks, target 256-byte boundaries (FLASH_PAGE_SIZE).
-            size = ((max_size - len(data) + 0xff) & 0xff) + 1
-            data.extend(socket.recv(size))
-        def ready():
-            return len(data) >= max_size or (boundary and boundary in data)
-        self._poll(select.POLLIN, ready = ready, action = action)
-
-    def parse(self):
-        self._recv_until(65536, b"\r\n\r\n")
-        head, self._data = self._data.split(b"\r\n\r\n", 1)
-        raw_headers = head.decode().split("\r\n")
-        self.method, self.uri, self.http_version = raw_headers[0].split(" ")
-        self.headers = []
-        self.size = 0
-        for row in raw_headers[1:]:
-            name, value = row.split(":", 1)
-            name, value = name.lower(), value.strip()
-            self.headers.append((name, value))
-            if name == "content-length":
-                self.size = int(value)
+    def _body_window(self, max_size):
+        # How much body may be read now without crossing framing.
+        if self._chunk_left is None:
+            return min(max_size, self.size - self._body_pos)
+        if self._chunk_left in (0, -1):
+            done = self._recv_until(1024, self._parse_chunk_header)
+            if done is None:
+                return None # Not here yet (asyncio mode, in a task).
+            if not done:
+                raise RuntimeError("Client disconnected or timed out.")
+            if self._chunk_left in (0, -1):
+                raise HTTPError(400, b"Bad chunked encoding")
+        return max(0, min(max_size, self._chunk_left))
+
+    def _readinto_some(self, mem):
+        # Read at least one byte of body into mem (waiting if needed); 0 at the end,
+        # None if nothing has arrived in a task in asyncio mode.
+        want = self._body_window(len(mem))
+        if not want:
+            return want
+        start = self._start
+        if start < self._end:
+            n = min(want, self._end - start)
+            mem[:n] = self._rx_mem[start:start + n]
+            self._start = start + n
+        else:
+            n = self._recv_some(mem[:want])
+            if n is None:
+                return None
+            self.bytes_in += n
+        self._body_pos += n
+        if self._chunk_left is not None:
+            self._chunk_left -= n
+        if self.max_body_size is not None and self._body_pos > self.max_body_size:
+            raise HTTPError(413, b"Request body too large")
+        return n
+
+    def _recv_some(self, mem):
+        if not self._wait(select.POLLIN):
+            raise RuntimeError("Client timed out.")
+        n = self.socket.readinto(mem)
+        if not n:
+            raise RuntimeError("Client disconnected.")
+        return n
+
+    def readinto(self, buf):
+        """Fill buf with request body (plain or chunked); return the count, 0 at the end.
+
+        In a task (see run_task) in asyncio mode, it returns what has arrived,
+        or None if nothing has: yield, and call it again."""
+        mem = memoryview(buf)
+        n = 0
+        while n < len(mem):
+            got = self._readinto_some(mem[n:])
+            if got is None:
+                return n or None
+            if not got:
+                break
+            n += got
+        return n
 
     def read_body(self, chunk_size = 1024):
-        remaining = self.size - self._body_pos
-        if not remaining:
-            return bytearray()
-        self._recv_until(min(chunk_size, remaining), None)
-        if not self._data:
-            raise RuntimeError("Client disconnected or timed out.")
-        self._data, ret = bytearray(), self._data
-        self._body_pos += len(ret)
-        return ret
+        buf = bytearray(chunk_size)
+        n = self._readinto_some(memoryview(buf))
+        if n is None:
+            return None
+        return buf if n == chunk_size else buf[:n]
 
     def request_body_callback(self, callback, chunk_size = 1024):
-        while self._body_pos < self.size:
-            callback(self.read_body(chunk_size))
+        while True:
+            data = self.read_body(chunk_size)
+            if not data:
+                return
+            callback(data)
+
+    def run_task(self, task):
+        """Run task, a generator that replies and reads the body in steps.
+
+        It yields after sending each chunk of output and when readinto
+        returns None. In asyncio mode it runs after the handler returns,
+        taking turns with other clients, so big uploads and downloads do
+        not stall them; elsewhere it runs right away. Call it last, as in
+        return request.run_task(self._upload(request)). Its output is not cached."""
+        self._capture = None
+        for _ in task:
+            pass
 
     def _send(self, data):
         mem = memoryview(data)
         self.output_started = True
-        data_i = 0
-        def f(socket):
-            nonlocal data_i
-            data_i += socket.send(mem[data_i:])
-        self._poll(select.POLLOUT, ready = lambda: data_i >= len(mem), action = f)
+        self.bytes_out += len(mem)
+        started = time.ticks_us()
+        i = 0
+        while i < len(mem) and self._wait(select.POLLOUT):
+            i += self.socket.send(mem[i:])
+        self.send_us += time.ticks_diff(time.ticks_us(), started)
 
-    def reply(self, content = b"", status = 200, mime = b"text/plain; charset=UTF-8"):
+    def reply(self, content = b"", status = 200, mime = b"text/plain; charset=UTF-8", length = None, headers = b""):
+        """Send content; the first call sets the headers, with Content-Length if length is given.
+
+        Extra headers are raw bytes, each line ending in \\r\\n."""
+        if type(content) == str:
+            content = content.encode()
+        capture = self._capture
+        if capture is not None:
+            if not self.output_started:
+                capture += (status, mime, headers)
+            self._capture_left -= len(content)
+            if self._capture_left < 0:
+                self._capture = None
+            elif content:
+                capture.append(bytes(content))
         if not self.output_started:
+            self.output_started = True
             status = str(status).encode()
             if type(mime) == str:
                 mime = mime.encode()
-            self._send(b"HTTP/1.0 " + status + b" -\r\nContent-Type: " + mime + b"\r\n\r\n")
-        if content:
-            self._send(content)
+            head = b"HTTP/1.1 " + status + b" -\r\n" + headers
+            if mime:
+                head += b"Content-Type: " + mime + b"\r\n"
+            self._head, self._length = head, length
+        if not content:
+            return
+        n = self._out_n
+        if n + len(content) > self.output_buffer_size:
+            self.flush()
+            if len(content) >= self.output_buffer_size:
+                return self._send_body(content)
+            n = 0
+        if not self._out or len(self._out) != self.output_buffer_size:
+            self._out = bytearray(self.output_buffer_size)
+        self._out[n : n + len(content)] = content
+        self._out_n = n + len(content)
+
+    def flush(self, final = False):
+        """Send the headers and buffered output; final also ends the response."""
+        data = memoryview(self._out)[:self._out_n] if self._out_n else b""
+        self._out_n = 0
+        head = self._head
+        if head is not None:
+            self._head = None
+            length = self._length
+            if length is None and final:
+                length = len(data)
+            if length is not None:
+                head += b"Content-Length: %d\r\n" % length
+            elif self.keep_alive and self.http_version == "HTTP/1.1":
+                head += b"Transfer-Encoding: chunked\r\n"
+                self._chunked = True
+            else:
+                self.keep_alive = False
+            head += b"Connection: keep-alive\r\n\r\n" if self.keep_alive else b"Connection: close\r\n\r\n"
+        if self._chunked:
+            data = (b"%x\r\n" % len(data) + data + b"\r\n" if data else b"") + (b"0\r\n\r\n" if final else b"")
+            self._chunked = not final
+        if self.method == "HEAD":
+            # Same headers as GET, but never a body.
+            data = b""
+        if head is not None:
+            data = head + data
+        if data:
+            self._send(data)
 
-    def reply_static(self, path, mime = None):
+    def _send_body(self, content):
+        if self.method == "HEAD":
+            return
+        if self._chunked:
+            content = b"%x\r\n" % len(content) + content + b"\r\n"
+        self._send(content)
+
+    def websocket(self, on_message = None):
+        """Accept a WebSocket upgrade; the connection is detached from this request.
+
+        Returns a WebSocket (see WebSocket.py); on_message(ws, message) gets
+        incoming text (str) and binary (bytes) messages."""
+        key = self.header("sec-websocket-key")
+        if self.output_started or not key or "websocket" not in self.header("upgrade", "").lower():
+            raise HTTPError(400, b"WebSocket upgrade expected")
+        import hashlib, binascii
+        from WebSocket import WebSocket
+        accept = binascii.b2a_base64(hashlib.sha1(key.strip().encode() + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest()).strip()
+        # Sent right away, also in asyncio mode, so that frames can follow.
+        WebRequest._send(self, b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        self.keep_alive = False
+        self._capture = None
+        ws = WebSocket(self.socket, self._rx_mem[self._start:self._end], on_message)
+        self.detach()
+        return ws
+
+    def _discard(self):
+        # Drop output that has not been sent, e.g. to send an error page instead.
+        self._capture = None
+        if self._head is not None:
+            self.output_started, self._head, self._out_n = False, None, 0
+        return not self.output_started
+
+    def finish(self):
+        """End the response; return True if the connection can take another request."""
+        self.flush(True)
+        if not self.body_done() and (self._chunk_left is not None or self.size - self._body_pos > 4096):
+            # Cheaper to reconnect than to skip a big or unknown unread body.
+            self.keep_alive = False
+        while self.keep_alive and not self.body_done() and self.read_body():
+            pass
+        return self.keep_alive
+
+    # Static files are sent in chunks of this size from one shared buffer.
+    static_chunk_size = 1024
+    _static_buffer = None
+    # Requests with more ranges than this get the whole file.
+    max_ranges = 8
+
+    def reply_static(self, path, mime = None, max_age = 0, precompressed = True):
+        """Send a file or the requested byte ranges, or 304 if the client's copy is current.
+
+        max_age sets Cache-Control (0 = always revalidate, None = no header).
+        precompressed = False ignores a path + ".gz" sibling, e.g. for raw file access."""
+        self._capture = None
+        # Prefer a precompressed sibling (see tools/Precompress.py) if the client takes gzip.
+        headers = b"Accept-Ranges: bytes\r\n"
         try:
-            with open(path, "rb") as f:
+            gz_stat = os.stat(path + ".gz") if precompressed else None
+            if gz_stat:
+                headers += b"Vary: Accept-Encoding\r\n"
+                if self.accepts_encoding("gzip"):
+                    headers += b"Content-Encoding: gzip\r\n"
+        except:
+            pass
+        try:
+            if b"gzip" in headers:
+                file, stat, tag = path + ".gz", gz_stat, "-gz"
+            else:
+                file, stat, tag = path, os.stat(path), ""
+            size = stat[6]
+            etag = f'"{size:x}-{stat[8]:x}{tag}"'
+            modified = http_date(stat[8])
+            headers += f"ETag: {etag}\r\nLast-Modified: {modified}\r\n".encode()
+            if max_age is not None:
+                headers += f"Cache-Control: max-age={max_age}\r\n".encode() if max_age else b"Cache-Control: no-cache\r\n"
+            match = self.header("if-none-match")
+            if match is not None:
+                fresh = match.strip() == "*" or etag in [i.strip().replace("W/", "") for i in match.split(",")]
+            else:
+                fresh = self.header("if-modified-since") == modified
+            if not mime:
                 try:
-                    ext = path[path.rindex(".", 1) + 1:]
-                    self.reply(mime = mime or self._ext_to_mime[ext])
+                    mime = self._ext_to_mime[path[path.rindex(".", 1) + 1:]]
                 except:
-                    data = f.read(1024)
-                    try:
-                        data.decode("UTF-8")
-                        self.reply(mime = b"text/plain; charset=UTF-8")
-                    except:
-                        self.reply(mime = b"application/octet-stream")
-                    self.reply(data)
-                    del data
-                while True:
-                    data = f.read(1024)
-                    if not data:
-                        return
-                    self.reply(data)
+                    pass
+            if fresh:
+                return self.reply(status = 304, mime = mime, length = size, headers = headers)
+            if not mime:
+                mime = b"application/octet-stream"
+                try:
+                    if file is path:
+                        with open(file, "rb") as f:
+                            buf = self._get_static_buffer()
+                            bytes(memoryview(buf)[:f.readinto(buf)]).decode("UTF-8")
+                        mime = b"text/plain; charset=UTF-8"
+                except:
+                    pass
+            if type(mime) == str:
+                mime = mime.encode()
+            ranges = self._ranges(size, etag, modified)
+            if ranges is None:
+                self.reply(mime = mime, length = size, headers = headers)
+                return self._send_parts(file, [(0, size)])
+            if not ranges:
+                return self.reply(status = 416, mime = None, headers = headers + b"Content-Range: bytes */%d\r\n" % size)
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                self.reply(status = 206, mime = mime, length = end - start,
+                    headers = headers + b"Content-Range: bytes %d-%d/%d\r\n" % (start, end - 1, size))
+                return self._send_parts(file, ranges)
+            boundary = b"WebMain-%08x" % (time.ticks_us() & 0xffffffff)
+            parts = []
+            for start, end in ranges:
+                parts.append(b"\r\n--" + boundary + b"\r\nContent-Type: " + mime + b"\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (start, end - 1, size))
+                parts.append((start, end))
+            parts.append(b"\r\n--" + boundary + b"--\r\n")
+            length = sum(part[1] - part[0] if type(part) is tuple else len(part) for part in parts)
+            self.reply(status = 206, mime = b"multipart/byteranges; boundary=" + boundary, length = length, headers = headers)
+            self._send_parts(file, parts)
         except:
             pass
 
+    def _ranges(self, size, etag, modified):
+        # Byte ranges as [(start, end)], [] if none is satisfiable, None for the whole file.
+        spec = self.header("range")
+        if not spec or not spec.startswith("bytes="):
+            return None
+        if_range = self.header("if-range")
+        if if_range is not None and if_range.strip() not in (etag, modified):
+            return None
+        ranges = []
+        try:
+            for item in spec[6:].split(","):
+                first, last = item.strip().split("-")
+                if first:
+                    start, end = int(first), int(last) + 1 if last else size
+                    if last and end <= start:
+                        return None
+                else:
+                    start, end = max(0, size - int(last)), size
+                if start < min(end, size):
+                    ranges.append((start, min(end, size)))
+        except ValueError:
+            return None
+        if len(ranges) > self.max_ranges:
+            return None
+        return ranges
+
+    def _get_static_buffer(self):
+        buf = WebRequest._static_buffer
+        if not buf or len(buf) != self.static_chunk_size:
+            buf = WebRequest._static_buffer = bytearray(self.static_chunk_size)
+        return buf
+
+    def _send_parts(self, file, parts):
+        # Send byte strings and (start, end) ranges of file, as a task (see run_task).
+        self.flush()
+        if self.method != "HEAD":
+            self.run_task(self._send_file(file, parts))
+
+    def _send_file(self, file, parts):
+        with open(file, "rb") as f:
+            for part in parts:
+                if type(part) is not tuple:
+                    self._send(part)
+                    yield
+                    continue
+                start, end = part
+                if self._sendfile(f, start, end):
+                    continue
+                f.seek(start)
+                buf = self._get_static_buffer()
+                mem = memoryview(buf)
+                while start < end:
+                    n = f.readinto(mem[:min(len(buf), end - start)])
+                    if not n:
+                        break
+                    self._send(mem[:n])
+                    start += n
+                    yield
+
+    def _sendfile(self, f, start, end):
+        # Let the kernel copy the file where possible (not on MicroPython).
+        sendfile = getattr(os, "sendfile", None)
+        if not sendfile or self._chunked:
+            return False
+        while start < end and self._wait(select.POLLOUT):
+            start += sendfile(self.socket.fileno(), f.fileno(), start, end - start)
+        return True
+
     _ext_to_mime = {
         "html": b"text/html; charset=UTF-8",
         "css": b"text/css; charset=UTF-8",
@@ -116,9 +623,42 @@ class WebRequest:
         "ico": b"image/x-icon",
         "svg": b"image/svg+xml",
         "webp": b"image/webp",
+        "txt": b"text/plain; charset=UTF-8",
+        "json": b"application/json",
+        "xml": b"application/xml",
+        "csv": b"text/csv; charset=UTF-8",
     }
 
 class WebMain:
+    # Shared by all instances, so that _log works before __init__ too.
+    logger = WebLog("WebMain.log")
+
+    # Front page; compiled on first use. Subclasses may replace it.
+    front_page_template = """{% args uname, machine, gc, time, modules %}<!DOCTYPE html>
+<title>WebMain on {{ uname.nodename }}</title>
+<h1>WebMain on {{ uname.nodename }}</h1>
+<p>machine: {{ uname.machine }}</p>
+<p>version: {{ uname.version }}</p>
+<p>reset_cause: {{ machine.reset_cause() }}</p>
+<p>freq: {{ machine.freq() }}</p>
+<p>time: {{ time }} (UTC)</p>
+<p>mem: {{ gc.mem_alloc() }} used, {{ gc.mem_free() }} free</p>
+<h2>Modules</h2>
+{% for module in modules %}
+{% if module.uri %}
+<li><a href='{{ module.uri }}'>{{ module.name }}</a>
+{% else %}
+<li>{{ module.name }}
+{% end %}
+{% end %}
+{% if not modules %}
+<p>Oh no, you haven't configured any modules!</p>
+{% end %}
+"""
+    _front_page_render = None
+    # How long the front page is cached, if WebMain has a cache_size.
+    front_page_cache_ttl = 10_000
+
     @classmethod
     def main(self):
         retry_acceptable = None
@@ -134,48 +674,136 @@ class WebMain:
         except BaseException as e:
             self._log(e)
         finally:
+            self.logger.flush()
             if main and main.socket:
                 main.socket.close()
         if retry_acceptable and retry_acceptable.expired():
             machine.reset()
 
     @classmethod
-    def _log(self, e):
-        if isinstance(e, BaseException):
-            sys.print_exception(e)
-            with open("WebMain.log", "a") as file:
-                file.write(f"\n---------\n{utc_time_str()}\n")
-                sys.print_exception(e, file)
-        else:
-            print(e)
-            with open("WebMain.log", "a") as file:
-                file.write(f"\n---------\n{utc_time_str()}\n")
-                file.write(e)
+    def _log(self, e, level = None):
+        self.logger.log(e, level)
 
     def __init__(
         self, network,
         display_errors = True, front_page = True,
         background_interval = 2_000,
         ntp = True,
+        use_async = False, use_thread = False,
+        keep_alive_timeout = 1_000, keep_alive_max = 16,
+        network_interval = 1_000,
+        metrics = False,
+        request_pool = 2, memory_budget = None,
+        cache_size = 0,
     ):
         self.network = network
-        self.socket = None
+        self.network_interval = network_interval
+        # Background scheduler: heap of (deadline, seq, module) on a non-wrapping clock.
+        self._ms, self._ticks = 0, time.ticks_ms()
+        self._clock_lock = allocate_lock()
+        self._schedule = []
+        self._seq = 0
+        self.socket = self._listen_poller = None
+        self.use_async = use_async
+        self.use_thread = use_thread
+        # Handoff between the serving and background threads; see WebThread.py.
+        self.state = SharedState()
+        self._posted, self._deferred = Queue(), Queue()
+        self.keep_alive_timeout = keep_alive_timeout
+        self.keep_alive_max = keep_alive_max
+        # Idle request objects kept for reuse, and how many exist in total.
+        # With memory_budget (bytes), no more than request_pool are ever
+        # made, and new connections get 503 while the heap has less free.
+        self.request_pool = request_pool
+        self.memory_budget = memory_budget
+        self._pool = []
+        self._requests = 0
         self.display_errors = display_errors
         self.front_page = front_page
         self.modules = []
+        # Route index: first uri segment -> candidate modules in insertion order.
+        self._routes = {}
+        self._wildcards = []
         self.background_interval = background_interval
+        self.cache = None
+        if cache_size:
+            from WebCache import WebCache
+            self.cache = WebCache(cache_size)
+        self.metrics = None
+        if metrics:
+            from WebMetrics import WebMetrics
+            self.metrics = WebMetrics()
+            self.add_module(self.metrics, "metrics", "/metrics", interval = 10_000, thread_safe = True)
+        self.add_module(self.logger, "log", "/log", interval = self.logger.flush_interval, thread_safe = True)
         if ntp:
             from SimpleNTPClient import WebSyncRTC
             self.add_module(WebSyncRTC())
 
     class WebModule:
-        def __init__(self, name, uri, handler):
+        def __init__(self, name, uri, handler, interval, cache_ttl = None, thread_safe = False):
             self.name = name
             self.uri = uri
             self.handler = handler
             self.background = True
+            self.interval = interval
+            self.deadline = None
+            self.cache_ttl = cache_ttl
+            # Held around handler calls, which may come from both threads.
+            self.lock = NoLock() if thread_safe else allocate_lock()
+
+    class LazyHandler:
+        """Handler given as "Module:Class" (or "Module:function"), imported on first use.
+
+        A class is instantiated without arguments. With unload_after (ms),
+        a module without background work is dropped from sys.modules after
+        that long without requests, and imported again when needed."""
+
+        def __init__(self, path, background, unload_after):
+            path = path.split(":")
+            self.module_name, self.attr = path[0], path[-1]
+            self.background = background
+            self.unload_after = unload_after
+            self.handler = None
+            self.used = 0
+
+        def load(self):
+            if not self.handler:
+                __import__(self.module_name)
+                handler = getattr(sys.modules[self.module_name], self.attr)
+                self.handler = handler() if isinstance(handler, type) else handler
+            return self.handler
+
+        def unload(self):
+            self.handler = None
+            sys.modules.pop(self.module_name, None)
+            gc.collect()
+
+        def __call__(self, request):
+            if request:
+                self.used = time.ticks_ms()
+                return self.load()(request)
+            if self.background:
+                return self.load()(None)
+            if not self.handler:
+                return
+            if self.unload_after is not None and time.ticks_diff(time.ticks_ms(), self.used) >= self.unload_after:
+                return self.unload()
+            return self.handler(None)
+
+    def add_module(self, handler, name = True, uri = True, interval = None, unload_after = None, cache_ttl = None, thread_safe = False):
+        """Add a module; handler(None) runs every interval ms (default background_interval).
 
-    def add_module(self, handler, name = True, uri = True):
+        If handler(None) returns an int, the next run is that many ms later instead.
+        The handler may be a string "Module:Class" to import it on the first
+        request, or on the first background run if interval is given; see
+        LazyHandler for unload_after. With cache_size, cache_ttl (ms) keeps
+        responses to GET; see WebCache.py. With use_thread, requests wait
+        while handler(None) runs unless thread_safe is True; see WebThread.py."""
+        lazy = type(handler) is str
+        if lazy:
+            handler = self.LazyHandler(handler, interval is not None, unload_after)
+            if name is True:
+                name = handler.attr
         if name is True:
             try:
                 name = handler.__name__
@@ -183,39 +811,142 @@ class WebMain:
                 name = handler.__class__.__name__
         if uri is True:
             uri = "/" + name
-        self.modules.append(self.WebModule(name, uri, handler))
+        module = self.WebModule(name, uri, handler, interval or self.background_interval, cache_ttl, thread_safe)
+        self.modules.append(module)
+        # The front page lists the modules.
+        self.invalidate("/", True)
+        # Lazy modules are not imported at boot by their first background run.
+        self._schedule_at(module, self._now() + (module.interval if lazy else 0))
+        if not uri:
+            return
+        key = self._route_key(uri)
+        if key is None:
+            # Matches many segments (like "/"); check it for every request.
+            self._wildcards.append(module)
+            for routes in self._routes.values():
+                routes.append(module)
+        else:
+            if key not in self._routes:
+                self._routes[key] = self._wildcards[:]
+            self._routes[key].append(module)
+
+    @staticmethod
+    def _route_key(uri):
+        # First path segment, or None for "/" and other non-segment uris.
+        if uri[0] != "/":
+            return None
+        end = len(uri)
+        for c in "/?":
+            i = uri.find(c, 1)
+            if 0 < i < end:
+                end = i
+        return uri[1:end] or None
 
-    def add_static(self, path, uri = True):
+    def add_static(self, path, uri = True, max_age = 0):
         if uri is True:
             uri = path
-        handler = lambda request: self._handle_static(request, path)
-        self.add_module(handler, "static: " + uri, uri)
+        handler = lambda request: self._handle_static(request, path, max_age)
+        self.add_module(handler, "static: " + uri, uri, thread_safe = True)
 
     def _run(self):
-        run_background_work = Timeout(-1)
+        if self.use_async:
+            # Serve many clients at once; see WebAsync.py.
+            from WebAsync import run
+            return run(self)
+        if self.use_thread:
+            # Background callbacks on another thread; see WebThread.py.
+            from WebThread import run
+            return run(self)
+        poller = select.poll()
+        network_check = 0
         while True:
-            if self.network.connected() and not self.socket:
-                self._listen()
-            if not self._accept_request() or run_background_work.expired():
-                for module in self.modules:
-                    try:
-                        module.background and module.handler(None)
-                    except KeyboardInterrupt as e:
-                        raise e
-                    except BaseException as e:
-                        self._log(e)
-                        module.background = False
-                run_background_work = Timeout(self.background_interval)
-            if not self._accept_request():
-                time.sleep_ms(10)
+            now = self._now()
+            if now >= network_check:
+                if self.network.connected() and not self.socket:
+                    self._listen()
+                    poller.register(self.socket, select.POLLIN)
+                network_check = now + self.network_interval
+            self._run_due(now)
+            self._run_queued()
+            if self.socket and self._accept_request():
+                continue
+            # Sleep until the next deadline or a new connection.
+            timeout = max(0, min(self._next_deadline(), network_check) - self._now())
+            if self.socket:
+                poller.poll(timeout)
+            else:
+                time.sleep_ms(timeout)
+
+    def invalidate(self, uri = None, exact = False):
+        """Drop cached responses whose URI starts with (or if exact, is) uri, or all of them."""
+        if self.cache:
+            self.cache.invalidate(uri, exact)
+
+    def post(self, fn, *args):
+        """Call fn(*args) soon on the thread that serves requests."""
+        self._posted.put(fn, args)
+
+    def defer(self, fn, *args):
+        """Call fn(*args) soon on the thread that runs background callbacks."""
+        self._deferred.put(fn, args)
+
+    def _run_queued(self):
+        self._posted.run(self._log)
+        self._deferred.run(self._log)
+
+    def _now(self):
+        # Milliseconds since start; unlike ticks_ms, this never wraps around.
+        with self._clock_lock:
+            ticks = time.ticks_ms()
+            self._ms += time.ticks_diff(ticks, self._ticks)
+            self._ticks = ticks
+            return self._ms
+
+    def _schedule_at(self, module, deadline):
+        module.deadline = deadline
+        self._seq += 1
+        heapq.heappush(self._schedule, (deadline, self._seq, module))
+
+    def _next_deadline(self):
+        return self._schedule[0][0] if self._schedule else self._now() + self.background_interval
+
+    def _run_due(self, now):
+        schedule = self._schedule
+        while schedule and schedule[0][0] <= now:
+            deadline, _, module = heapq.heappop(schedule)
+            if module.deadline != deadline or not module.background:
+                continue
+            started = time.ticks_us()
+            try:
+                with module.lock:
+                    delay = module.handler(None)
+            except KeyboardInterrupt as e:
+                raise e
+            except BaseException as e:
+                self._log(e)
+                module.background = False
+                continue
+            finally:
+                if self.metrics:
+                    self.metrics.background(module, time.ticks_diff(time.ticks_us(), started))
+            now = self._now()
+            if type(delay) is int:
+                deadline = now + delay
+            else:
+                deadline += module.interval
+                if deadline <= now:
+                    deadline = now + module.interval
+            self._schedule_at(module, deadline)
 
     def _listen(self):
         print(f"Starting HTTP server http://{self.network.ip}/")
         self.socket = socket.socket()
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.setblocking(False)
-        self.socket.bind(socket.getaddrinfo("0.0.0.0", 80)[0][-1])
+        self.socket.bind(resolve("0.0.0.0", 80))
         self.socket.listen(4)
+        self._listen_poller = select.poll()
+        self._listen_poller.register(self.socket, select.POLLIN)
 
     def _accept_request(self):
         try:
@@ -223,51 +954,170 @@ class WebMain:
         except:
             return
 
+        request = None
+        try:
+            request = self._take_request(WebRequest, client)
+            if not request:
+                self._refuse(client)
+                return True
+            for i in range(self.keep_alive_max):
+                if i and not self._keep_alive_wait(request):
+                    break
+                if not self._serve(request, self.keep_alive_timeout if i else 2000):
+                    break
+        finally:
+            # Upgraded connections (WebSocket) have been detached from the request.
+            if not request or request.socket:
+                client.close()
+            if request:
+                self._release_request(request)
+        return True
+
+    # How often an idle kept-alive connection checks for other work (ms).
+    idle_check_interval = 20
+
+    def _keep_alive_wait(self, request):
+        # One connection is served at a time here, so wait for its next
+        # request only while no other client or background task is waiting.
+        end = self._now() + self.keep_alive_timeout
+        while not request._pending():
+            now = self._now()
+            if now >= end or (self._listen_poller and self._listen_poller.poll(0)):
+                return False
+            if not self.use_thread and self._next_deadline() <= now:
+                return False
+            request._readable(min(self.idle_check_interval, end - now))
+        return True
+
+    def _take_request(self, cls, connection):
+        # A pooled request object for the connection; None if the memory budget says no.
+        budget = self.memory_budget
+        if budget is not None:
+            if gc.mem_free() < budget:
+                gc.collect()
+            if gc.mem_free() < budget or not self._pool and self._requests >= self.request_pool:
+                return None
+        if self._pool:
+            request = self._pool.pop()
+        else:
+            request = cls()
+            self._requests += 1
+        request.attach(connection)
+        return request
+
+    def _release_request(self, request):
+        request.detach()
+        if len(self._pool) < self.request_pool:
+            self._pool.append(request)
+        else:
+            self._requests -= 1
+
+    @staticmethod
+    def _refuse(socket):
+        try:
+            socket.send(b"HTTP/1.1 503 -\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        except:
+            pass
+
+    def _serve(self, request, timeout):
+        request.reset()
+        try:
+            if not request.parse(timeout):
+                return
+        except BaseException as e:
+            self._fail(request, e, 401, b"Failed to parse request")
+            return
+        times = self._process(request)
+        try:
+            return request.finish()
+        except:
+            return
+        finally:
+            self._record(request, times)
+
+    def _process(self, request):
+        # Returns (parse, handler) microseconds for _record after finish().
+        print(f"{utc_time_str()} {request.method} {request.uri}")
+        parsed = time.ticks_us()
         try:
-            error = (401, b"Failed to parse request")
-            request = WebRequest(client)
-            request.parse()
-            print(f"{utc_time_str()} {request.method} {request.uri}")
-            error = (500, b"Failed to process request")
             self._dispatch_request(request)
-            if not request.output_started:
+            if not request.output_started and not request._tasks:
                 request.reply(status = 404, content = b"Not found")
         except BaseException as e:
+            self._fail(request, e, 500, b"Failed to process request")
+        return (
+            None if request.started is None else time.ticks_diff(parsed, request.started),
+            time.ticks_diff(time.ticks_us(), parsed) - request.send_us,
+        )
+
+    def _record(self, request, times):
+        # After finish(), when the buffered output has been sent and counted.
+        if self.metrics:
+            self.metrics.record(request, *times)
+
+    def _fail(self, request, e, status, content):
+        request.keep_alive = False
+        if self.metrics:
+            self.metrics.error(request)
+        if isinstance(e, HTTPError):
+            status, content = e.args
+        else:
             sys.print_exception(e)
-            try:
-                if not request.output_started:
-                    request.reply(status = error[0], content = error[1])
-                if self.display_errors:
-                    request.reply(b"\n\n")
-                    sys.print_exception(e, client)
-            except:
-                pass
-        finally:
-            client.close()
-        return True
+        try:
+            if request._discard():
+                request.reply(status = status, content = content)
+            if self.display_errors and not isinstance(e, HTTPError):
+                trace = io.StringIO()
+                sys.print_exception(e, trace)
+                request.reply(b"\n\n" + trace.getvalue().encode())
+            request.flush(True)
+        except:
+            pass
 
     def _dispatch_request(self, request):
-        for module in self.modules:
-            if self._dispatch_request_if_matches(request, module.uri, module.handler):
+        uri = request.uri
+        cache = self.cache
+        if cache and request.method == "GET":
+            entry = cache.get("GET " + uri)
+            if entry:
+                request.module = entry[3]
+                request.reply(entry[7], entry[4], entry[5], headers = entry[6])
                 return
+        for module in self._routes.get(uri and self._route_key(uri), self._wildcards):
+            request.module = module
+            with module.lock:
+                if self._dispatch_request_if_matches(request, module.uri, module.handler, module.cache_ttl):
+                    return
+        request.module = None
         if self.front_page:
-            self._dispatch_request_if_matches(request, "/", self)
+            self._dispatch_request_if_matches(request, "/", self, self.front_page_cache_ttl)
 
-    def _dispatch_request_if_matches(self, request, script_name, handler):
+    def _dispatch_request_if_matches(self, request, script_name, handler, cache_ttl = None):
         if script_name and request.uri.startswith(script_name):
             l = len(script_name)
             if (len(request.uri) <= l or request.uri[l] in "/?" or request.uri[l-1] in "/?"):
                 request.script_name = script_name
                 request.path_info = request.uri[l:]
-                handler(request)
+                if cache_ttl and self.cache and request.method == "GET":
+                    request._capture, request._capture_left = [], self.cache.max_bytes
+                    handler(request)
+                    self._cache_store(request, cache_ttl)
+                else:
+                    handler(request)
                 return True
 
-    def _handle_static(self, request, path):
+    def _cache_store(self, request, ttl):
+        capture, request._capture = request._capture, None
+        if capture and str(capture[0]) == "200":
+            body = b"".join(capture[3:])
+            self.cache.put("GET " + request.uri, ttl, request.module, capture[0], capture[1], capture[2], body)
+
+    def _handle_static(self, request, path, max_age):
         if not request:
             return
         if request.path_info and "../" in request.path_info:
             return
-        request.reply_static(path + request.path_info)
+        request.reply_static(path + request.path_info, max_age = max_age)
 
     def __call__(self, request):
         if not request:
@@ -279,23 +1129,9 @@ class WebMain:
             return
 
         gc.collect()
-        uname = os.uname()
         request.reply(status = 200, mime = b"text/html; charset=UTF-8")
-        request.reply(f"""<!DOCTYPE html>
-            <title>WebMain on {uname.nodename}</title>
-            <h1>WebMain on {uname.nodename}</h1>
-            <p>machine: {uname.machine}</p>
-            <p>version: {uname.version}</p>
-            <p>reset_cause: {machine.reset_cause()}</p>
-            <p>freq: {machine.freq()}</p>
-            <p>time: {utc_time_str()} (UTC)</p>
-            <p>mem: {gc.mem_alloc()} used, {gc.mem_free()} free</p>
-            <h2>Modules</h2>
-        """)
-        for module in self.modules:
-            if module.uri:
-                request.reply(f"<li><a href='{module.uri}'>{module.name}</a>")
-            else:
-                request.reply(f"<li>{module.name}")
-        if not self.modules:
-            request.reply(b"<p>Oh no, you haven't configured any modules!</p>")
+        if not self._front_page_render:
+            self._front_page_render = WebTemplate.compile_template(self.front_page_template)
+        WebTemplate.render(request, self._front_page_render, os.uname(), machine, gc, utc_time_str(), self.modules)
+        if self.metrics:
+            self.metrics.summary(request)
@@ -0,0 +1,153 @@
+"""Request and background metrics for WebMain: WebMain(network, metrics = True).
+
+Counters and histograms live in fixed-size arrays, so recording a sample
+allocates nothing. The /metrics page is in Prometheus text format.
+"""
+
+import gc
+from array import array
+from WebThread import allocate_lock
+
+def _zeros(n):
+    return array("I", bytes(4 * n))
+
+class Histogram:
+    """Latency histogram in microseconds, with a ring of the latest samples."""
+
+    # Bucket upper bounds in microseconds; one more bucket for +Inf.
+    bounds = (250, 500, 1_000, 2_500, 5_000, 10_000, 25_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000)
+    ring_size = 16
+
+    def __init__(self):
+        self.counts = _zeros(len(self.bounds) + 1)
+        # Sum as microseconds below one second plus whole seconds; keeps ints small.
+        self.total = _zeros(2)
+        self.ring = _zeros(self.ring_size)
+        self.ring_pos = 0
+
+    def add(self, us):
+        i = 0
+        for bound in self.bounds:
+            if us <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        total = self.total
+        total[0] += us % 1_000_000
+        total[1] += us // 1_000_000
+        if total[0] >= 1_000_000:
+            total[0] -= 1_000_000
+            total[1] += 1
+        self.ring[self.ring_pos] = us
+        self.ring_pos = (self.ring_pos + 1) % self.ring_size
+
+    def count(self):
+        return sum(self.counts)
+
+    def recent_max(self):
+        return max(self.ring)
+
+    def write(self, out, name, labels):
+        out(f"# TYPE {name} histogram\n")
+        n = 0
+        for i, bound in enumerate(self.bounds):
+            n += self.counts[i]
+            out(f'{name}_bucket{{{labels}le="{bound / 1_000_000}"}} {n}\n')
+        n += self.counts[-1]
+        out(f'{name}_bucket{{{labels}le="+Inf"}} {n}\n')
+        labels = "{" + labels[:-1] + "}" if labels else ""
+        out(f"{name}_sum{labels} {self.total[1]}.{self.total[0]:06}\n")
+        out(f"{name}_count{labels} {n}\n")
+
+class ModuleStats:
+    def __init__(self, name):
+        self.name = name.replace("\\", "\\\\").replace('"', '\\"')
+        # requests, errors, bytes in, bytes out
+        self.counters = _zeros(4)
+        self.handler = Histogram()
+        self.send = Histogram()
+        self.background = Histogram()
+
+class WebMetrics:
+    """WebMain module serving metrics; also samples free memory in the background."""
+
+    def __init__(self):
+        self.parse = Histogram()
+        self.parse_errors = _zeros(1)
+        # Replaced as a whole under the lock (like SharedState), so that
+        # the other thread can iterate over it while a module is added.
+        self.modules = {}
+        self._lock = allocate_lock()
+        self.mem_free_min = _zeros(1)
+
+    def stats(self, module):
+        stats = self.modules.get(module)
+        if not stats:
+            with self._lock:
+                stats = self.modules.get(module)
+                if not stats:
+                    modules = dict(self.modules)
+                    stats = modules[module] = ModuleStats(module.name if module else "front page")
+                    self.modules = modules
+        return stats
+
+    def record(self, request, parse_us, handler_us):
+        # handler_us excludes sending; request.send_us has all of it.
+        stats = self.stats(request.module)
+        counters = stats.counters
+        counters[0] += 1
+        counters[2] += request.bytes_in
+        counters[3] += request.bytes_out
+        if parse_us is not None:
+            self.parse.add(parse_us)
+        stats.handler.add(max(0, handler_us))
+        stats.send.add(request.send_us)
+
+    def error(self, request):
+        if request.method is None:
+            self.parse_errors[0] += 1
+        else:
+            self.stats(request.module).counters[1] += 1
+
+    def background(self, module, us):
+        self.stats(module).background.add(us)
+
+    def _sample_memory(self):
+        free = gc.mem_free()
+        if not self.mem_free_min[0] or free < self.mem_free_min[0]:
+            self.mem_free_min[0] = free
+        return free
+
+    def __call__(self, request):
+        if not request:
+            self._sample_memory()
+            return
+        if request.path_info not in ("", "?"):
+            return
+        free = self._sample_memory()
+        request.reply(mime = b"text/plain; version=0.0.4; charset=UTF-8")
+        out = request.reply
+        out(f"# TYPE webmain_mem_free_bytes gauge\nwebmain_mem_free_bytes {free}\n")
+        out(f"# TYPE webmain_mem_alloc_bytes gauge\nwebmain_mem_alloc_bytes {gc.mem_alloc()}\n")
+        out(f"# TYPE webmain_mem_free_min_bytes gauge\nwebmain_mem_free_min_bytes {self.mem_free_min[0]}\n")
+        out(f"# TYPE webmain_parse_errors_total counter\nwebmain_parse_errors_total {self.parse_errors[0]}\n")
+        self.parse.write(out, "webmain_parse_seconds", "")
+        for i, name in enumerate(("requests", "request_errors", "bytes_in", "bytes_out")):
+            out(f"# TYPE webmain_{name}_total counter\n")
+            for stats in self.modules.values():
+                out(f'webmain_{name}_total{{module="{stats.name}"}} {stats.counters[i]}\n')
+        for name in ("handler", "send", "background"):
+            for stats in self.modules.values():
+                histogram = getattr(stats, name)
+                if histogram.count():
+                    histogram.write(out, f"webmain_{name}_seconds", f'module="{stats.name}",')
+
+    def summary(self, request):
+        """HTML table for the front page."""
+        request.reply(f"<h2>Metrics</h2><p>mem free min: {self.mem_free_min[0]}</p>"
+            "<table><tr><th>module<th>requests<th>errors<th>recent max ms<th>background max ms")
+        for stats in self.modules.values():
+            c = stats.counters
+            request.reply(f"<tr><td>{stats.name}<td>{c[0]}<td>{c[1]}"
+                f"<td>{stats.handler.recent_max() / 1000}<td>{stats.background.recent_max() / 1000}")
+        request.reply(b"</table>")
@@ -0,0 +1,208 @@
+"""WebSocket connections for WebMain modules, for pushing updates.
+
+class Clock:
+    def __init__(self):
+        self.clients = WebSocketGroup(on_message = lambda ws, msg: ws.send(msg))
+
+    def __call__(self, request):
+        if not request:
+            # Background tick: push to every subscribed browser.
+            self.clients.broadcast(utc_time_str())
+            return 1000
+        if request.path_info == "/ws":
+            return self.clients.accept(request)
+        request.reply(...)
+
+Incoming messages, pings and closes are handled in poll(), which
+broadcast() also calls; a group without broadcasts should poll() in
+the module's background tick.
+"""
+
+import select, struct, sys
+
+def _encode(buf, opcode, data):
+    # Server frame (unmasked) into buf; returns (header, payload) views.
+    n = len(data)
+    buf[0] = 0x80 | opcode
+    if n < 126:
+        buf[1] = n
+        i = 2
+    elif n < 0x10000:
+        buf[1] = 126
+        struct.pack_into("!H", buf, 2, n)
+        i = 4
+    else:
+        buf[1] = 127
+        struct.pack_into("!Q", buf, 2, n)
+        i = 10
+    mem = memoryview(buf)
+    if i + n <= len(buf):
+        mem[i : i + n] = data
+        return mem[: i + n], None
+    return mem[:i], data
+
+class WebSocket:
+    """One WebSocket connection; see WebRequest.websocket()."""
+
+    # Largest accepted incoming message; bigger ones close the connection.
+    max_message_size = 1024
+    # How long a send may wait for a slow client before it is dropped.
+    send_timeout = 200
+
+    def __init__(self, socket, data = b"", on_message = None):
+        self.socket = socket
+        self.on_message = on_message
+        self._rx = bytearray(self.max_message_size + 14)
+        self._tx = bytearray(128)
+        self._n = len(data)
+        self._rx[: self._n] = data
+        socket.setblocking(False)
+        self._poller = select.poll()
+        self._poller.register(socket, select.POLLOUT)
+
+    def _send_frame(self, head, data):
+        try:
+            for mem in (head, data):
+                if mem is None:
+                    continue
+                mem = memoryview(mem)
+                while len(mem):
+                    if not self._poller.poll(self.send_timeout):
+                        raise OSError("send timeout")
+                    mem = mem[self.socket.send(mem) :]
+            return True
+        except OSError:
+            self.close(None)
+            return False
+
+    def send(self, data):
+        """Send a text (str) or binary message; returns False if the client is gone."""
+        if not self.socket:
+            return False
+        if type(data) == str:
+            return self._send_frame(*_encode(self._tx, 1, data.encode()))
+        return self._send_frame(*_encode(self._tx, 2, data))
+
+    def close(self, code = 1000):
+        if not self.socket:
+            return
+        if code:
+            self._send_frame(*_encode(self._tx, 8, struct.pack("!H", code)))
+        if self.socket:
+            self._poller.unregister(self.socket)
+            self.socket.close()
+            self.socket = None
+
+    def poll(self):
+        """Handle incoming frames; returns False once the connection is closed."""
+        while self.socket:
+            free = memoryview(self._rx)[self._n :]
+            try:
+                n = self.socket.readinto(free)
+            except OSError:
+                n = None # Mostly EAGAIN
+            if n == 0:
+                self.close(None)
+                break
+            if n:
+                self._n += n
+            while self.socket and self._frame():
+                pass
+            if not n:
+                break
+        return self.socket is not None
+
+    def _frame(self):
+        # Handle the frame at the start of the buffer; False if it is incomplete.
+        buf, n = self._rx, self._n
+        if n < 2:
+            return False
+        first, size, i = buf[0], buf[1] & 0x7f, 2
+        if size == 126:
+            if n < 4:
+                return False
+            size, i = (buf[2] << 8) | buf[3], 4
+        elif size == 127:
+            if n < 10:
+                return False
+            size, i = struct.unpack_from("!Q", buf, 2)[0], 10
+        if not buf[1] & 0x80:
+            self.close(1002) # Clients must mask their frames.
+            return False
+        if i + 4 + size > len(buf):
+            self.close(1009)
+            return False
+        if n < i + 4 + size:
+            return False
+        mask, i = i, i + 4
+        for j in range(size):
+            buf[i + j] ^= buf[mask + (j & 3)]
+        payload = bytes(buf[i : i + size])
+        rest = n - i - size
+        if rest:
+            buf[:rest] = buf[i + size : n]
+        self._n = rest
+        opcode = first & 0x0f
+        if opcode == 8:
+            self.close(None if size < 2 else struct.unpack("!H", payload[:2])[0])
+        elif opcode == 9:
+            self._send_frame(*_encode(self._tx, 10, payload))
+        elif opcode in (1, 2) and first & 0x80:
+            # Errors close this client only, not the group or the module.
+            try:
+                message = payload.decode() if opcode == 1 else payload
+            except UnicodeError:
+                self.close(1007)
+                return False
+            if self.on_message:
+                try:
+                    self.on_message(self, message)
+                except Exception as e:
+                    sys.print_exception(e)
+                    self.close(1011)
+                    return False
+        elif opcode != 10:
+            self.close(1003) # Fragmented or unknown frames are not supported.
+        return True
+
+class WebSocketGroup:
+    """Subscribed clients of a module, with broadcast from background ticks."""
+
+    def __init__(self, on_message = None, max_clients = 4):
+        self.on_message = on_message
+        self.max_clients = max_clients
+        self.clients = []
+        self._tx = bytearray(1024)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def accept(self, request):
+        """Upgrade the request and subscribe it; replies 503 when full."""
+        self.poll()
+        if len(self.clients) >= self.max_clients:
+            return request.reply(status = 503, content = b"Too many WebSocket clients")
+        ws = request.websocket(self.on_message)
+        self.clients.append(ws)
+        return ws
+
+    def poll(self):
+        """Handle incoming frames and drop closed clients."""
+        self.clients = [ws for ws in self.clients if ws.poll()]
+
+    def broadcast(self, data):
+        """Send a message to every client; the frame is encoded only once."""
+        self.poll()
+        if type(data) == str:
+            head, payload = _encode(self._tx, 1, data.encode())
+        else:
+            head, payload = _encode(self._tx, 2, data)
+        for ws in self.clients:
+            ws._send_frame(head, payload)
+        self.clients = [ws for ws in self.clients if ws.socket]
+        return len(self.clients)
+
+    def close(self):
+        for ws in self.clients:
+            ws.close()
+        self.clients = []
@@ -0,0 +1,133 @@
+"""Tiny template engine: templates compile to generator functions.
+
+Syntax:
+    {% args title, items %}     arguments of the compiled function
+    {{ expression }}            str(expression), not escaped
+    {% for x in items %} ... {% end %}
+    {% if x %} ... {% elif y %} ... {% else %} ... {% end %}
+    {% any other Python statement %}
+
+Usage in a module:
+    WebTemplate.render(request, "page.tpl", title, items)
+
+Templates are compiled once and cached. For deployment, precompile them on
+your computer: python3 WebTemplate.py page.tpl writes page_tpl.py (which
+mpy-cross can turn into .mpy); load() prefers it over the .tpl file.
+"""
+
+import sys
+
+_BLOCK = ("for", "if", "while", "with", "try")
+_CONTINUE = ("elif", "else", "except", "finally")
+
+def translate(source, name = "render"):
+    """Python source of the generator function for the template."""
+    args = ""
+    body = []
+    indent = 1
+    text, values = [], []
+
+    def flush():
+        if not text:
+            return
+        if values:
+            fmt = "".join("%s" if t is None else t.replace("%", "%%") for t in text)
+            body.append("    " * indent + f"yield {repr(fmt)} % ({', '.join(values)},)")
+        else:
+            body.append("    " * indent + f"yield {repr(''.join(text))}")
+        text.clear()
+        values.clear()
+
+    i = 0
+    while i < len(source):
+        a = source.find("{", i)
+        while a >= 0 and source[a + 1 : a + 2] not in ("{", "%"):
+            a = source.find("{", a + 1)
+        if a < 0:
+            text.append(source[i:])
+            break
+        tag = source[a + 1]
+        b = source.find("}}" if tag == "{" else "%}", a + 2)
+        if b < 0:
+            raise ValueError(f"unclosed tag at {a}")
+        literal = source[i:a]
+        code = source[a + 2 : b].strip()
+        i = b + 2
+        if tag == "{":
+            literal and text.append(literal)
+            text.append(None)
+            values.append(f"({code})")
+            continue
+        # A statement alone on its line takes the whole line with it.
+        line_start = source.rfind("\n", 0, a) + 1
+        if not source[line_start:a].strip() and source[i : i + 1] in ("\n", ""):
+            literal = literal[: len(literal) - (a - line_start)]
+            i += 1
+        literal and text.append(literal)
+        flush()
+        word = code.split(None, 1)[0] if code else ""
+        if word == "args":
+            args = code[4:].strip()
+        elif word == "end":
+            indent -= 1
+            if indent < 1:
+                raise ValueError("unexpected {% end %}")
+        elif word in _CONTINUE:
+            # pass keeps an empty block valid.
+            body.append("    " * (indent - 1) + code.rstrip(":") + ":")
+            body.append("    " * indent + "pass")
+        elif word in _BLOCK:
+            body.append("    " * indent + code.rstrip(":") + ":")
+            indent += 1
+            body.append("    " * indent + "pass")
+        else:
+            body.append("    " * indent + code)
+    flush()
+    if indent != 1:
+        raise ValueError("missing {% end %}")
+    return "\n".join([f"def {name}({args}):"] + body + ["    return", "    yield", ""])
+
+def compile_template(source):
+    """Compile template source to a generator function."""
+    namespace = {}
+    exec(translate(source), namespace)
+    return namespace["render"]
+
+_cache = {}
+
+def load(path):
+    """Compiled template for a .tpl file; cached, precompiled module preferred."""
+    template = _cache.get(path)
+    if template:
+        return template
+    module = path.rsplit("/", 1)[-1].rsplit(".", 1)[0] + "_tpl"
+    try:
+        template = __import__(module).render
+    except ImportError:
+        with open(path) as f:
+            template = compile_template(f.read())
+    _cache[path] = template
+    return template
+
+def render(request, template, *args):
+    """Reply a template (path or compiled function) with the given arguments."""
+    if isinstance(template, str):
+        template = load(template)
+    # WebRequest buffers the output, so fragments can go out one by one.
+    for part in template(*args):
+        request.reply(part)
+
+def main(argv):
+    if not argv:
+        print(__doc__)
+        return 1
+    for path in argv:
+        target = path.rsplit(".", 1)[0] + "_tpl.py"
+        with open(path) as f:
+            source = translate(f.read())
+        with open(target, "w") as f:
+            f.write(source)
+        print(f"{path} -> {target}")
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,102 @@
+"""Threaded mode for WebMain: WebMain(network, use_thread = True).
+
+Background callbacks (handler(None)) run on a second thread, which the
+rp2 and esp32 ports put on the second core, so a slow background task
+no longer delays requests and long requests don't starve background
+work. Calls into one module are still serialized, so its requests wait
+for its own background callback. Modules added with thread_safe = True
+run on both threads at once and should hand data over explicitly:
+ - main.state.publish(name = value) in the background, and
+   main.state.get(name) in request handlers (copy-on-write snapshots),
+ - main.post(fn, *args) runs fn on the thread that serves requests,
+   e.g. for WebSocket broadcasts; main.defer(fn, *args) runs it on the
+   background thread. Both work in the other modes too.
+"""
+
+import select, time
+class NoLock:
+    # Without threads, or for thread-safe modules, nothing needs locking.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+try:
+    from _thread import allocate_lock, start_new_thread
+except ImportError:
+    allocate_lock = NoLock
+
+class Queue:
+    """Lock-protected handoff queue of calls."""
+
+    def __init__(self):
+        self._lock = allocate_lock()
+        self._items = []
+
+    def put(self, fn, args):
+        with self._lock:
+            self._items.append((fn, args))
+
+    def run(self, log):
+        """Run the queued calls; exceptions go to log."""
+        if not self._items:
+            return
+        with self._lock:
+            items, self._items = self._items, []
+        for fn, args in items:
+            try:
+                fn(*args)
+            except Exception as e:
+                log(e)
+
+class SharedState:
+    """Values published by one thread and read by another.
+
+    Writers replace the whole dict under a lock, so readers never see it
+    change while they look at it and need no lock."""
+
+    def __init__(self):
+        self._lock = allocate_lock()
+        self.values = {}
+
+    def publish(self, **values):
+        with self._lock:
+            new = dict(self.values)
+            new.update(values)
+            self.values = new
+
+    def get(self, name, default = None):
+        return self.values.get(name, default)
+
+# Longest wait before queued calls run.
+handoff_interval = 50
+
+def _background(main):
+    while not main._stopped:
+        main._deferred.run(main._log)
+        main._run_due(main._now())
+        time.sleep_ms(max(0, min(main._next_deadline() - main._now(), handoff_interval)))
+
+def run(main):
+    main._stopped = False
+    start_new_thread(_background, (main,))
+    try:
+        poller = select.poll()
+        network_check = time.ticks_ms()
+        while True:
+            if time.ticks_diff(time.ticks_ms(), network_check) >= 0:
+                if main.network.connected() and not main.socket:
+                    main._listen()
+                    poller.register(main.socket, select.POLLIN)
+                network_check = time.ticks_add(time.ticks_ms(), main.network_interval)
+            main._posted.run(main._log)
+            if main.socket and main._accept_request():
+                continue
+            timeout = max(0, min(time.ticks_diff(network_check, time.ticks_ms()), handoff_interval))
+            if main.socket:
+                poller.poll(timeout)
+            else:
+                time.sleep_ms(timeout)
+    finally:
+        main._stopped = True
@@ -0,0 +1,47 @@
+"""Compare Checksum.checksum with the byte-at-a-time checksum_py.
+
+Usage: python3 tools/ChecksumTest.py [SEED]
+
+Checks every length from 0 to 1473 bytes (one past the largest ICMP
+payload in an Ethernet frame) with random, all-zero and all-0xff data,
+as bytes, bytearray and an unaligned memoryview, and with a pseudo-header
+passed as initial.
+Also runs on the device (mpremote run tools/ChecksumTest.py) to check
+the viper version.
+"""
+
+import os, random, struct, sys
+
+try:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+except:
+    pass # MicroPython: Checksum.py is already on the device.
+
+from Checksum import checksum, checksum_py
+
+MAX_LENGTH = 1473
+
+def main(argv):
+    if len(argv) > 1 or (argv and not argv[0].isdigit()):
+        print(__doc__)
+        return 1
+    random.seed(int(argv[0]) if argv else 1)
+    failed = 0
+    for n in range(MAX_LENGTH + 1):
+        data = bytes(random.getrandbits(8) for _ in range(n + 1))
+        for name, buf in (("bytes", data[:n]), ("bytearray", bytearray(data[:n])), ("memoryview", memoryview(data)[1:]),
+                ("zeros", bytes(n)), ("0xff", b"\xff" * n)):
+            if checksum(buf) != checksum_py(buf):
+                print(f"FAIL {name} length {n}: {checksum(buf):#06x} != {checksum_py(buf):#06x}")
+                failed += 1
+        # UDP-style pseudo-header as a partial sum.
+        header = data[:12] if n >= 12 else bytes(12)
+        initial = sum(struct.unpack("!6H", header))
+        if checksum(data[:n], initial) != checksum_py(header + data[:n]):
+            print(f"FAIL initial length {n}")
+            failed += 1
+    print(f"{'FAIL' if failed else 'ok'}: lengths 0-{MAX_LENGTH}, {failed} mismatches")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
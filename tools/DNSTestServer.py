@@ -0,0 +1,54 @@
+"""DNS server that answers A queries from the command line, optionally slowly, for SimpleDNS.
+
+Usage: python3 tools/DNSTestServer.py [--port PORT] [--delay MS] [--ttl S] NAME=IP...
+
+Answers A queries for the given names and NXDOMAIN for the rest,
+holding each answer for --delay milliseconds to simulate a slow server.
+Port 53 needs root, so the default is 5300:
+SimpleDNS.resolver = SimpleDNS.SimpleDNS("192.168.0.2", port = 5300)
+"""
+
+import socket, struct, sys, time
+
+def answer(query, names, ttl = 60):
+    """Build the response for a query packet."""
+    ident, flags, qd = struct.unpack_from("!HHH", query)
+    i, labels = 12, []
+    while query[i]:
+        labels.append(query[i + 1 : i + 1 + query[i]].decode())
+        i += query[i] + 1
+    question = query[12 : i + 5]
+    ip = names.get(".".join(labels).lower())
+    rcode = 0 if ip else 3 # NXDOMAIN
+    header = struct.pack("!HHHHHH", ident, 0x8180 | rcode, 1, 1 if ip else 0, 0, 0)
+    if not ip:
+        return header + question
+    record = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, ttl, 4) + bytes(int(x) for x in ip.split("."))
+    return header + question + record
+
+def serve(names, port = 5300, delay_ms = 0, ttl = 60, host = "0.0.0.0"):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((host, port))
+    print(f"DNS on {host}:{port}, delay {delay_ms} ms, {len(names)} names")
+    while True:
+        query, address = s.recvfrom(512)
+        print(f"query from {address[0]}")
+        time.sleep(delay_ms / 1000)
+        try:
+            s.sendto(answer(query, names, ttl), address)
+        except (IndexError, struct.error):
+            pass
+
+def main(argv):
+    options = {"--port": 5300, "--delay": 0, "--ttl": 60}
+    while len(argv) > 1 and argv[0] in options:
+        options[argv[0]] = int(argv[1])
+        argv = argv[2:]
+    if not argv or not all("=" in x for x in argv):
+        print(__doc__)
+        return 1
+    names = dict(x.lower().split("=", 1) for x in argv)
+    serve(names, options["--port"], options["--delay"], options["--ttl"])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,107 @@
+"""Fast requests to WebMain while slow clients download or upload, to compare serving modes.
+
+Usage: python3 tools/LoadTest.py [--clients 1,4,16] [--seconds S] [--rate BYTES_PER_S]
+    [--upload BYTES] HOST[:PORT] [FAST_PATH [SLOW_PATH]]
+
+For each count in --clients, that many slow clients fetch SLOW_PATH (default
+/WebFileManager, about 8 kB) over and over, reading --rate bytes per second
+each; with --upload they POST that many bytes to SLOW_PATH at that rate
+instead, e.g. /WebFileManager?write=/load.bin. Meanwhile one client requests
+FAST_PATH (default /) back to back. Prints its requests per second, its
+median and p99 latency, and how many bytes per second the slow clients
+moved in total. Run it against WebMain(network) and
+WebMain(network, use_async = True) and compare.
+"""
+
+import socket, sys, threading, time
+
+def connect(host, port, timeout = 10, rcvbuf = None):
+    s = socket.socket()
+    if rcvbuf:
+        # A small window, so that the server can't hand over everything at once.
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    s.settimeout(timeout)
+    s.connect((host, port))
+    return s
+
+def fetch(host, port, path):
+    """One GET; returns the status line."""
+    s = connect(host, port)
+    try:
+        s.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        data = b""
+        while True:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data.split(b"\r\n", 1)[0]
+    finally:
+        s.close()
+
+def slow_client(host, port, path, rate, upload, stop, moved):
+    step = 256
+    while not stop.is_set():
+        try:
+            s = connect(host, port, 30, 2048)
+            if upload:
+                s.sendall(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {upload}\r\nConnection: close\r\n\r\n".encode())
+                for i in range(0, upload, step):
+                    moved.append(s.send(bytes(min(step, upload - i))))
+                    time.sleep(step / rate)
+            else:
+                s.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            while True:
+                data = s.recv(step)
+                if not data:
+                    break
+                moved.append(len(data))
+                time.sleep(step / rate)
+            s.close()
+        except OSError:
+            time.sleep(0.1)
+
+def run(host, port, fast_path, slow_path, clients, seconds, rate, upload):
+    stop = threading.Event()
+    moved = []
+    threads = [threading.Thread(target = slow_client, args = (host, port, slow_path, rate, upload, stop, moved), daemon = True) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)
+    times, errors = [], 0
+    moved.clear()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        started = time.monotonic()
+        try:
+            ok = b" 200 " in fetch(host, port, fast_path)
+        except OSError:
+            ok = False
+        if ok:
+            times.append(time.monotonic() - started)
+        else:
+            errors += 1
+    stop.set()
+    rate = sum(moved) / seconds
+    times.sort()
+    p = lambda q: times[min(len(times) - 1, int(q * len(times)))] * 1000 if times else float("nan")
+    print(f"{clients:3} slow: {len(times) / seconds:7.1f} req/s, median {p(0.5):7.1f} ms, p99 {p(0.99):7.1f} ms, "
+        f"{errors} errors; slow clients {rate / 1000:.1f} kB/s")
+
+def main(argv):
+    options = {"--clients": "1,4,16", "--seconds": "10", "--rate": "2000", "--upload": "0"}
+    while len(argv) > 1 and argv[0] in options:
+        options[argv[0]] = argv[1]
+        argv = argv[2:]
+    if not 1 <= len(argv) <= 3 or argv[0].startswith("-"):
+        print(__doc__)
+        return 1
+    host, _, port = argv[0].partition(":")
+    fast_path = argv[1] if len(argv) > 1 else "/"
+    slow_path = argv[2] if len(argv) > 2 else "/WebFileManager"
+    for clients in options["--clients"].split(","):
+        run(host, int(port or 80), fast_path, slow_path, int(clients), float(options["--seconds"]),
+            int(options["--rate"]), int(options["--upload"]))
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
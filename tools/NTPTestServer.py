@@ -0,0 +1,53 @@
+"""SNTP server with a known clock offset and reply delay, to check SimpleNTPClient against.
+
+Usage: python3 tools/NTPTestServer.py [--port PORT] [--offset MS] [--delay MS]
+
+Answers every request from the host clock shifted by --offset and
+holds each reply for --delay milliseconds between receive and transmit,
+so offset and round-trip correction can be checked against known values.
+Port 123 needs root, so the default is 12300:
+SimpleNTPClient(["192.168.0.2", "192.168.0.3"], port = 12300).
+"""
+
+import socket, struct, sys, time
+
+NTP_DELTA = 2208988800
+
+def ntp_time(offset_ms = 0):
+    t = time.time() + offset_ms / 1000 + NTP_DELTA
+    return int(t) & 0xffffffff, int(t % 1 * 2**32)
+
+def reply(request, offset_ms = 0, delay_ms = 0):
+    """Build the server packet for a client request."""
+    if len(request) < 48:
+        return None
+    received = ntp_time(offset_ms)
+    time.sleep(delay_ms / 1000)
+    # LI 0, version from request, mode 4 (server); stratum 1, "TEST" reference.
+    version = request[0] >> 3 & 7
+    return struct.pack("!BBbb4s4s4s", version << 3 | 4, 1, 6, -20, b"\0" * 4, b"\0" * 4, b"TEST") \
+        + struct.pack("!II", *received) + request[40:48] \
+        + struct.pack("!II", *received) + struct.pack("!II", *ntp_time(offset_ms))
+
+def serve(port = 12300, offset_ms = 0, delay_ms = 0, host = "0.0.0.0"):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((host, port))
+    print(f"SNTP on {host}:{port}, offset {offset_ms} ms, delay {delay_ms} ms")
+    while True:
+        request, address = s.recvfrom(1024)
+        packet = reply(request, offset_ms, delay_ms)
+        if packet:
+            s.sendto(packet, address)
+
+def main(argv):
+    options = {"--port": 12300, "--offset": 0, "--delay": 0}
+    while len(argv) > 1 and argv[0] in options:
+        options[argv[0]] = int(argv[1])
+        argv = argv[2:]
+    if argv:
+        print(__doc__)
+        return 1
+    serve(options["--port"], options["--offset"], options["--delay"])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+"""Simulated ICMP echo replies for PingMonitor, checked on a fake clock.
+
+Usage: python3 tools/PingTestResponder.py
+
+Raw ICMP sockets need root, and the kernel answers loopback pings by
+itself, so FakeICMPSocket stands in for PingMonitor's socket: it answers
+echo requests after a chosen delay per host and sequence number, drops
+the ones chosen as lost, and can inject crafted replies. main() runs
+PingMonitor against it on a simulated clock and checks id/seq matching,
+loss and jitter, and loss when no socket can be opened.
+"""
+
+import os, socket, struct, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Simulated clock in ms; main() makes PingMonitor read it through time.ticks_*.
+_now = [0]
+
+def fake_clock():
+    time.ticks_ms = lambda: _now[0]
+    time.ticks_us = lambda: _now[0] * 1000
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+
+def echo_reply(ident, seq, payload = b""):
+    """IPv4 header and ICMP echo reply, as a raw socket returns them."""
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 28 + len(payload), 0, 0, 64, 1, 0, bytes(4), bytes(4))
+    return ip + struct.pack("!BBHHH", 0, 0, 0, ident, seq) + payload
+
+class FakeICMPSocket:
+    """Answers echo requests in memory; delay(ip, seq) gives ms, or None for a lost ping."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.queue = []
+        self.sent = []
+
+    def sendto(self, packet, address):
+        kind, code, _, ident, seq = struct.unpack_from("!BBHHH", packet)
+        self.sent.append((address[0], ident, seq))
+        delay = self.delay(address[0], seq)
+        if kind == 8 and delay is not None:
+            self.inject(echo_reply(ident, seq, bytes(packet[8:])), delay)
+
+    def inject(self, packet, delay = 0):
+        """Deliver any packet after delay ms."""
+        self.queue.append((_now[0] + delay, packet))
+        self.queue.sort(key = lambda x: x[0])
+
+    def readinto(self, buf):
+        if not self.queue or self.queue[0][0] > _now[0]:
+            return None # Like EAGAIN.
+        packet = self.queue.pop(0)[1]
+        n = min(len(buf), len(packet))
+        buf[:n] = packet[:n]
+        return n
+
+    def close(self):
+        pass
+
+def run(monitor, ms, step = 1):
+    """Drive monitor.update() for ms of simulated time."""
+    end = _now[0] + ms
+    while _now[0] < end:
+        monitor.update()
+        _now[0] += step
+
+def check(name, got, expected):
+    ok = got == expected
+    print(f"{'ok  ' if ok else 'FAIL'} {name}: {got}" + ("" if ok else f", expected {expected}"))
+    return ok
+
+def main(argv):
+    if argv:
+        print(__doc__)
+        return 1
+    fake_clock()
+    from PingMonitor import PingMonitor
+    ok = True
+
+    # Jitter: replies alternate between 10 and 30 ms.
+    # Loss: every fourth ping to the second host gets no reply.
+    def delay(ip, seq):
+        if ip == "10.0.0.1":
+            return 10 if seq & 1 else 30
+        return None if seq % 4 == 0 else 5
+    fake = FakeICMPSocket(delay)
+    monitor = PingMonitor(["10.0.0.1", "10.0.0.2"], interval = 100, timeout = 50, history = 8)
+    monitor.socket = fake
+    run(monitor, 800)
+    a, b = monitor.hosts
+    ok &= check("ids differ per host", a.ident != b.ident, True)
+    ok &= check("10.0.0.1 stats (sent, lost, min, avg, max, jitter)", a.stats(monitor.timeout), (8, 0, 10, 20, 30, 20))
+    ok &= check("10.0.0.2 stats", b.stats(monitor.timeout), (8, 2, 5, 5, 5, 0))
+    ok &= check("10.0.0.2 lost in a row", b.lost_in_row(monitor.timeout), 1)
+
+    # Crafted replies: another process' id, a stale seq, a duplicate,
+    # a reply after the timeout, and one that is not an echo reply.
+    fake.delay = lambda ip, seq: None
+    run(monitor, 1) # Sends the next ping to both hosts.
+    received = a.received
+    fake.inject(echo_reply(a.ident ^ 0x8000, a.seq))
+    fake.inject(echo_reply(a.ident, (a.seq - 40) & 0xffff))
+    fake.inject(b"\x45" + bytes(19) + struct.pack("!BBHHH", 3, 1, 0, a.ident, a.seq))
+    run(monitor, 5)
+    ok &= check("foreign id, stale seq and unreachable ignored", (a.received, a.in_flight(monitor.timeout)), (received, True))
+    fake.inject(echo_reply(a.ident, a.seq))
+    fake.inject(echo_reply(a.ident, a.seq))
+    run(monitor, 5)
+    ok &= check("duplicate reply counted once", a.received, received + 1)
+    ok &= check("rtt of the matched reply", a.rtt[a.seq % len(a.rtt)], 6)
+    fake.inject(echo_reply(b.ident, b.seq), 60)
+    run(monitor, 70) # Past the reply, before the next ping.
+    # Seq 8 was already dropped above, so this makes two in a row.
+    ok &= check("reply after the timeout counts as lost", (b.received, b.lost_in_row(monitor.timeout)), (6, 2))
+
+    # No memory for a socket: the pings still count, as lost, so that
+    # SimpleWLAN reconnects and finally reports is_broken().
+    def no_memory(*args):
+        raise OSError(12, "ENOMEM")
+    real, socket.socket = socket.socket, no_memory
+    try:
+        monitor = PingMonitor(["10.0.0.1"], interval = 100, timeout = 50)
+        run(monitor, 1000)
+    finally:
+        socket.socket = real
+    host = monitor.hosts[0]
+    ok &= check("ENOMEM: broken, sent, lost in a row", (monitor.broken, host.sent, host.lost_in_row(monitor.timeout)), (True, 10, 10))
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,54 @@
+"""Write .gz siblings of static files for WebRequest.reply_static.
+
+Usage: python3 tools/Precompress.py [--min-saving PERCENT] DIR_OR_FILE...
+
+Writes a .gz sibling next to each compressible file (and removes stale
+ones). The .gz goes out with Content-Encoding: gzip to clients that
+accept it. Copy the .gz files to the device as well.
+"""
+
+import gzip, os, sys
+
+EXTENSIONS = ("html", "css", "js", "svg", "json", "txt", "xml", "csv")
+
+def precompress(path, min_saving = 10):
+    """Write path.gz if it saves at least min_saving percent; return its size or None."""
+    with open(path, "rb") as f:
+        data = f.read()
+    # Fixed mtime keeps the output (and its ETag) stable across runs.
+    packed = gzip.compress(data, 9, mtime = 0)
+    if len(packed) * 100 > len(data) * (100 - min_saving):
+        if os.path.exists(path + ".gz"):
+            os.unlink(path + ".gz")
+        return None
+    with open(path + ".gz", "wb") as f:
+        f.write(packed)
+    return len(packed)
+
+def walk(path):
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            yield from walk(os.path.join(path, name))
+    elif path.rsplit(".", 1)[-1].lower() in EXTENSIONS:
+        yield path
+
+def main(argv):
+    min_saving = 10
+    if len(argv) > 1 and argv[0] == "--min-saving":
+        min_saving = int(argv[1])
+        argv = argv[2:]
+    if not argv:
+        print(__doc__)
+        return 1
+    total, total_packed = 0, 0
+    for root in argv:
+        for path in walk(root):
+            size = os.path.getsize(path)
+            packed = precompress(path, min_saving)
+            total += size
+            total_packed += packed or size
+            print(f"{path}: {size} -> {packed or 'not compressed'}")
+    print(f"total: {total} -> {total_packed} bytes")
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))